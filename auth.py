@@ -1,8 +1,13 @@
 # auth.py
+import json
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from typing import Optional
+from os import getenv
+from typing import Dict, Optional, Set
 from jose import JWTError, jwt
 from bson import ObjectId
+from broker import broker
 from db import user_collection
 from utils import hash_password, verify_password
 
@@ -11,6 +16,96 @@ SECRET_KEY = "ahsanahmedkhan"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60
 
+TOKEN_CACHE_SIZE = int(getenv("TOKEN_CACHE_SIZE", "10000"))
+TOKEN_CACHE_TTL_SECONDS = int(getenv("TOKEN_CACHE_TTL_SECONDS", "300"))
+
+TOKENS_CHANNEL = "tokens"
+
+# What authenticated handlers get back; the picture and hash stay in Mongo
+USER_PROJECTION = {"pp": 0, "hashed_password": 0}
+
+
+class TokenCache:
+    """
+    LRU of tokens that already passed signature verification, with the user
+    projection they resolved to. An entry lives for TOKEN_CACHE_TTL_SECONDS
+    but never past the token's own exp claim. drop_user() announces on the
+    broker so every node forgets the user's tokens, not just this one.
+    """
+
+    def __init__(self, max_size: int = TOKEN_CACHE_SIZE, ttl: int = TOKEN_CACHE_TTL_SECONDS):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: "OrderedDict[str, list]" = OrderedDict()  # token -> [expires_at, payload, user]
+        self.tokens_by_email: Dict[str, Set[str]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def start(self):
+        await broker.subscribe(TOKENS_CHANNEL, self._on_broker_message)
+
+    async def stop(self):
+        await broker.unsubscribe(TOKENS_CHANNEL)
+
+    def get(self, token: str) -> Optional[list]:
+        entry = self.entries.get(token)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry[0] <= time.time():
+            self.invalidate_token(token)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(token)
+        self.hits += 1
+        return entry
+
+    def put(self, token: str, payload: dict, user: Optional[dict] = None) -> list:
+        expires_at = time.time() + self.ttl
+        if payload.get("exp") is not None:
+            expires_at = min(expires_at, float(payload["exp"]))
+        entry = [expires_at, payload, user]
+        self.entries[token] = entry
+        self.entries.move_to_end(token)
+        self.tokens_by_email.setdefault(payload.get("sub"), set()).add(token)
+        while len(self.entries) > self.max_size:
+            oldest, oldest_entry = self.entries.popitem(last=False)
+            self._forget(oldest, oldest_entry)
+        return entry
+
+    def invalidate_token(self, token: str):
+        entry = self.entries.pop(token, None)
+        if entry is not None:
+            self._forget(token, entry)
+
+    def invalidate_user(self, email: str):
+        """Drop every token of a user cached on this node."""
+        for token in self.tokens_by_email.pop(email, set()):
+            self.entries.pop(token, None)
+
+    async def drop_user(self, email: str):
+        """Drop every cached token of a user on all nodes, e.g. on logout or profile change."""
+        self.invalidate_user(email)
+        await broker.publish(TOKENS_CHANNEL, json.dumps({"email": email}))
+
+    async def _on_broker_message(self, channel: str, payload: str):
+        self.invalidate_user(json.loads(payload)["email"])
+
+    def stats(self) -> dict:
+        return {"size": len(self.entries), "users": len(self.tokens_by_email), "hits": self.hits,
+                "misses": self.misses}
+
+    def _forget(self, token: str, entry: list):
+        email = entry[1].get("sub")
+        tokens = self.tokens_by_email.get(email)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self.tokens_by_email[email]
+
+
+token_cache = TokenCache()
+
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
@@ -23,13 +118,43 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     return encoded_jwt
 
 
+def verify_token(token: str) -> dict:
+    """Return the token's payload, decoding it only on a cache miss. Raises JWTError."""
+    entry = token_cache.get(token)
+    if entry is not None:
+        return entry[1]
+    payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    token_cache.put(token, payload)
+    return payload
+
+
+async def get_verified_user(token: str) -> Optional[dict]:
+    """
+    Resolve a token to its user projection, or None if the user is gone.
+    Hits neither the JWT library nor MongoDB while the cache entry is warm.
+    Raises JWTError for bad tokens.
+    """
+    entry = token_cache.get(token)
+    if entry is not None and entry[2] is not None:
+        return entry[2]
+    payload = entry[1] if entry is not None else jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    email = payload.get("sub")
+    if email is None:
+        return None
+    user = await user_collection.find_one({"email": email}, USER_PROJECTION)
+    if user is None:
+        return None
+    token_cache.put(token, payload, user)
+    return user
+
+
 async def validate_token(token: str):
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = verify_token(token)
         email: str = payload.get("sub")
         if email is None:
             return {"isValid": False, "message": "Invalid token"}
-        user = await user_collection.find_one({"email": email})  # Ensure this is awaited
+        user = await get_verified_user(token)
         if not user:
             return {"isValid": False, "message": "User not found"}
         return {"isValid": True, "email": email, "user_id": str(user["_id"])}
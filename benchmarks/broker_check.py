@@ -0,0 +1,91 @@
+# benchmarks/broker_check.py
+"""
+Checks RedisBroker against fakeredis, no Redis server needed: two brokers on
+one fake server stand in for two nodes. Covers publish/subscribe,
+publish_many, unsubscribe and keyed payloads surviving the round trip.
+
+    pip install -r requirements.txt -r benchmarks/requirements.txt
+    python benchmarks/broker_check.py
+"""
+import asyncio
+import os
+import sys
+
+from fakeredis import FakeServer
+from fakeredis.aioredis import FakeRedis
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from broker import RedisBroker, keyed_payload, split_key, user_channel  # noqa: E402
+
+TIMEOUT_SECONDS = 5
+
+
+class Inbox:
+    """A broker handler that collects what it is handed."""
+
+    def __init__(self):
+        self.received = asyncio.Queue()
+
+    async def __call__(self, channel: str, payload: str):
+        await self.received.put((channel, payload))
+
+    async def next(self):
+        return await asyncio.wait_for(self.received.get(), TIMEOUT_SECONDS)
+
+    async def nothing(self, wait: float = 0.3) -> bool:
+        await asyncio.sleep(wait)
+        return self.received.empty()
+
+
+async def run_checks():
+    server = FakeServer()
+    node_a = RedisBroker(FakeRedis(server=server, decode_responses=True))
+    node_b = RedisBroker(FakeRedis(server=server, decode_responses=True))
+    await node_a.start()
+    await node_b.start()
+    failures = []
+
+    def check(name, ok):
+        print(f"{'ok  ' if ok else 'FAIL'} {name}")
+        if not ok:
+            failures.append(name)
+
+    try:
+        alice, bob = Inbox(), Inbox()
+        await node_a.subscribe(user_channel("alice@example.com"), alice)
+        await node_b.subscribe(user_channel("bob@example.com"), bob)
+
+        await node_a.publish(user_channel("bob@example.com"), '{"content": "hi"}')
+        check("publish reaches a subscriber on another node",
+              await bob.next() == (user_channel("bob@example.com"), '{"content": "hi"}'))
+
+        await node_b.publish_many([user_channel("alice@example.com"), user_channel("bob@example.com")], "{}")
+        check("publish_many reaches every channel",
+              (await alice.next())[1] == "{}" and (await bob.next())[1] == "{}")
+
+        payload = keyed_payload("receipt:alice@example.com:\x1egroup:read", '{"type": "receipt"}')
+        await node_a.publish(user_channel("bob@example.com"), payload)
+        key, body = split_key((await bob.next())[1])
+        check("keyed payload keeps its key and body", (key, body) ==
+              ("receipt:alice@example.com:group:read", '{"type": "receipt"}'))
+        check("unkeyed payload has no key", split_key('{"a": 1}') == (None, '{"a": 1}'))
+
+        await node_b.unsubscribe(user_channel("bob@example.com"))
+        await node_a.publish(user_channel("bob@example.com"), "{}")
+        check("unsubscribed channel receives nothing", await bob.nothing())
+        check("unsubscribe drops the handler", user_channel("bob@example.com") not in node_b.handlers)
+
+        await node_b.subscribe(user_channel("bob@example.com"), bob)
+        await node_a.publish(user_channel("bob@example.com"), "{}")
+        check("resubscribing delivers again", (await bob.next())[1] == "{}")
+    except asyncio.TimeoutError:
+        check("delivery within timeout", False)
+    finally:
+        await node_a.stop()
+        await node_b.stop()
+    return failures
+
+
+if __name__ == "__main__":
+    sys.exit(1 if asyncio.run(run_checks()) else 0)
@@ -0,0 +1,277 @@
+# benchmarks/load_test.py
+"""
+Load test for the chat hot paths against an in-memory MongoDB.
+
+Starts benchmarks/serve.py in a subprocess, seeds users over REST, then drives
+/login, thousands of /ws/{token} clients, /messages and /users/{email}, and
+reports latency percentiles, throughput, memory per connection and event-loop
+lag. Results are written as JSON; pass --compare to fail on regressions.
+
+    pip install -r requirements.txt -r benchmarks/requirements.txt
+    python benchmarks/load_test.py --users 200 --messages 20 --compare benchmarks/baselines/baseline.json
+
+baselines/baseline.json was recorded with exactly that command on a single
+core (see its "meta"); compare only runs with the same flags on comparable
+hardware. --users 2000 is the capacity run: it needs several cores, and
+thousands of sockets need a raised file-descriptor limit (ulimit -n 65536).
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import httpx
+import websockets
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# 1x1 PNG, so registration exercises the media store without dominating the run
+PIXEL = ("data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk"
+         "+M9QDwADhgGAWjR9awAAAABJRU5ErkJggg==")
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def latency_summary(seconds, wall_seconds=None):
+    summary = {
+        "count": len(seconds),
+        "p50_ms": round(percentile(seconds, 50) * 1000, 3),
+        "p99_ms": round(percentile(seconds, 99) * 1000, 3),
+        "max_ms": round(max(seconds, default=0.0) * 1000, 3),
+    }
+    if wall_seconds:
+        summary["requests_per_second"] = round(len(seconds) / wall_seconds, 1)
+    return summary
+
+
+async def timed_requests(client, requests, concurrency):
+    """Run (method, url, kwargs) tuples with bounded concurrency; returns (latencies, wall time, errors)."""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors = [], 0
+
+    async def one(method, url, kwargs):
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            response = await client.request(method, url, **kwargs)
+            elapsed = time.perf_counter() - started
+            if response.status_code >= 400:
+                errors += 1
+            else:
+                latencies.append(elapsed)
+            return response
+
+    started = time.perf_counter()
+    responses = await asyncio.gather(*(one(*request) for request in requests))
+    return latencies, time.perf_counter() - started, errors, responses
+
+
+async def wait_for_server(client, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if (await client.get("/__bench__/stats")).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError("Benchmark server did not come up")
+
+
+async def seed(client, users, concurrency):
+    emails = [f"bench{i}@example.com" for i in range(users)]
+    await timed_requests(client, [
+        ("POST", "/register", {"json": {"username": f"bench{i}", "email": email, "password": "password123", "pp": PIXEL}})
+        for i, email in enumerate(emails)
+    ], concurrency)
+    latencies, wall, errors, responses = await timed_requests(client, [
+        ("POST", "/login", {"json": {"email": email, "password": "password123"}}) for email in emails
+    ], concurrency)
+    tokens = {email: response.json()["token"] for email, response in zip(emails, responses)}
+    # Pair users up: bench0 <-> bench1, bench2 <-> bench3, ...
+    partners = {email: emails[i ^ 1] for i, email in enumerate(emails) if (i ^ 1) < len(emails)}
+    await timed_requests(client, [
+        ("POST", f"/chats/{email}/join", {"params": {"token": tokens[email]}, "json": {"chatId": partner}})
+        for email, partner in partners.items()
+    ], concurrency)
+    return tokens, partners, {**latency_summary(latencies, wall), "errors": errors}
+
+
+async def run_websockets(client, base_ws, tokens, partners, messages, rate, timeout):
+    expected = len(partners) * messages
+    latencies = []
+    rate_limited = 0
+    all_delivered = asyncio.Event()
+    stats_before = (await client.get("/__bench__/stats")).json()
+
+    async def receiver(email, socket):
+        nonlocal rate_limited
+        async for frame in socket:
+            message = json.loads(frame)
+            if message.get("type") == "error" and message.get("detail") == "Rate limit exceeded":
+                # Rejected by the server, not lost in delivery
+                rate_limited += len(message.get("clientMsgIds") or [None])
+            elif message.get("sender") == email or message.get("type") != "bench":
+                continue
+            else:
+                latencies.append(time.perf_counter() - json.loads(message["content"])["sentAt"])
+            if len(latencies) + rate_limited >= expected:
+                all_delivered.set()
+
+    sockets = {}
+    for email in partners:
+        sockets[email] = await websockets.connect(f"{base_ws}/ws/{tokens[email]}", max_queue=None)
+    await asyncio.sleep(1)
+    stats_connected = (await client.get("/__bench__/stats")).json()
+    await client.post("/__bench__/reset")
+
+    receivers = [asyncio.create_task(receiver(email, socket)) for email, socket in sockets.items()]
+
+    async def sender(email, socket):
+        for sequence in range(messages):
+            await socket.send(json.dumps({
+                "type": "bench",
+                "clientMsgId": sequence,
+                "chatId": partners[email],
+                "content": json.dumps({"sentAt": time.perf_counter()}),
+                "timestamp": datetime.utcnow().isoformat(),
+                "identifier": [email, partners[email]],
+            }))
+            await asyncio.sleep(1 / rate)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(sender(email, socket) for email, socket in sockets.items()))
+    try:
+        await asyncio.wait_for(all_delivered.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    wall = time.perf_counter() - started
+    stats_after = (await client.get("/__bench__/stats")).json()
+
+    for task in receivers:
+        task.cancel()
+    await asyncio.gather(*(socket.close() for socket in sockets.values()), return_exceptions=True)
+
+    lag = stats_after["loop_lag_seconds"]
+    return {
+        "ws_delivery": {
+            **latency_summary(latencies),
+            "expected": expected,
+            "rate_limited": rate_limited,
+            "lost": expected - len(latencies) - rate_limited,
+            "messages_per_second": round(len(latencies) / wall, 1),
+        },
+        "memory": {
+            "connections": len(sockets),
+            "rss_before_bytes": stats_before["rss_bytes"],
+            "rss_connected_bytes": stats_connected["rss_bytes"],
+            "bytes_per_connection": round(
+                (stats_connected["rss_bytes"] - stats_before["rss_bytes"]) / max(len(sockets), 1)),
+        },
+        "event_loop_lag": {
+            "samples": len(lag),
+            "p50_ms": round(percentile(lag, 50) * 1000, 3),
+            "p99_ms": round(percentile(lag, 99) * 1000, 3),
+            "max_ms": round(max(lag, default=0.0) * 1000, 3),
+        },
+    }
+
+
+async def run_rest(client, tokens, partners, requests, concurrency):
+    emails = list(partners)
+    results = {}
+    for name, build in (
+        ("rest_messages", lambda email: ("GET", f"/messages/{partners[email]}/{email}", {"params": {"token": tokens[email]}})),
+        ("rest_users", lambda email: ("GET", f"/users/{email}", {})),
+    ):
+        latencies, wall, errors, _ = await timed_requests(
+            client, [build(emails[i % len(emails)]) for i in range(requests)], concurrency)
+        results[name] = {**latency_summary(latencies, wall), "errors": errors}
+    return results
+
+
+def compare(results, baseline_path, tolerance):
+    """Print metrics that got worse than the baseline by more than `tolerance`; return True if any did."""
+    with open(baseline_path) as f:
+        baseline = json.load(f)["metrics"]
+    regressed = False
+    for section, metrics in results["metrics"].items():
+        for key, value in metrics.items():
+            old = baseline.get(section, {}).get(key)
+            if not isinstance(value, (int, float)) or not isinstance(old, (int, float)) or old == 0:
+                continue
+            if key.endswith("_ms") or key.endswith("bytes_per_connection") or key in ("lost", "errors"):
+                change = (value - old) / old  # lower is better
+            elif key.endswith("per_second"):
+                change = (old - value) / old  # higher is better
+            else:
+                continue
+            marker = "REGRESSION" if change > tolerance else "ok"
+            regressed |= change > tolerance
+            print(f"{marker:>10}  {section}.{key}: {old} -> {value} ({change:+.1%})")
+    return regressed
+
+
+async def main(args):
+    port = args.port
+    server = subprocess.Popen([sys.executable, os.path.join(HERE, "serve.py"), "--port", str(port)])
+    try:
+        # Expire idle connections before uvicorn's 5s keep-alive does, or a reused one can be reset mid-request
+        limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency,
+                              keepalive_expiry=2)
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=60) as client:
+            await wait_for_server(client)
+            tokens, partners, login = await seed(client, args.users, args.concurrency)
+            metrics = {"login": login}
+            metrics.update(await run_websockets(client, f"ws://127.0.0.1:{port}", tokens, partners,
+                                                args.messages, args.rate, args.timeout))
+            metrics.update(await run_rest(client, tokens, partners, args.rest_requests, args.concurrency))
+    finally:
+        server.terminate()
+        server.wait(timeout=10)
+
+    results = {
+        "meta": {
+            "users": args.users,
+            "messages_per_client": args.messages,
+            "rate_per_client": args.rate,
+            "rest_requests": args.rest_requests,
+            "concurrency": args.concurrency,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "recorded_at": datetime.utcnow().isoformat(),
+        },
+        "metrics": metrics,
+    }
+    print(json.dumps(metrics, indent=2))
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.compare and compare(results, args.compare, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000, help="users to seed; every one opens a socket")
+    parser.add_argument("--messages", type=int, default=20, help="messages each client sends")
+    parser.add_argument("--rate", type=float, default=2.0, help="messages per second per client")
+    parser.add_argument("--rest-requests", type=int, default=2000, help="requests per REST endpoint")
+    parser.add_argument("--concurrency", type=int, default=100, help="concurrent REST requests")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for stragglers")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--output", default=os.path.join(HERE, "baselines", "latest.json"))
+    parser.add_argument("--compare", help="baseline JSON to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression")
+    asyncio.run(main(parser.parse_args()))
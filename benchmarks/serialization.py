@@ -0,0 +1,93 @@
+# benchmarks/serialization.py
+"""
+Serialization throughput of the /messages and /users payloads: the previous
+path (str() every field, pydantic response_model validation, jsonable_encoder,
+json.dumps) against the fast one (serializers that skip redundant work,
+encoding.dumps, no validation).
+
+    python benchmarks/serialization.py --items 200 --rounds 200
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from typing import List
+
+from bson import ObjectId
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+from pydantic import parse_obj_as  # noqa: E402
+
+from db import serialize_contact, serialize_message  # noqa: E402
+from encoding import dumps, orjson  # noqa: E402
+from schemas import UserResponse  # noqa: E402
+
+
+def legacy_serialize_message(message):
+    return {
+        "id": str(message["_id"]),
+        "type": str(message["type"]),
+        "chatId": str(message["chatId"]),
+        "content": str(message["content"]),
+        "timestamp": str(message["timestamp"]),
+        "sender": str(message["sender"]),
+        "identifier": message.get("identifier", []),
+    }
+
+
+def legacy_serialize_user(user):
+    return {
+        "id": str(user["_id"]),
+        "username": user["username"],
+        "email": user["email"],
+        "chats": [str(chat) for chat in user.get("chats", [])],
+        "pp": str(user["pp"]),
+    }
+
+
+def legacy_render(content) -> bytes:
+    # What JSONResponse did after FastAPI's jsonable_encoder
+    return json.dumps(jsonable_encoder(content), ensure_ascii=False, allow_nan=False, indent=None,
+                      separators=(",", ":")).encode()
+
+
+def rate(fn, rounds: int) -> float:
+    started = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    return rounds / (time.perf_counter() - started)
+
+
+def main(args):
+    messages = [{
+        "_id": ObjectId(), "type": "text", "chatId": "bob@example.com", "sender": "alice@example.com",
+        "content": f"Message number {i} with a bit of text to make it realistic", "timestamp": f"2024-01-01T00:00:{i:02d}",
+        "identifier": ["alice@example.com", "bob@example.com"], "conversation": "alice@example.com|bob@example.com",
+    } for i in range(args.items)]
+    users = [{
+        "_id": ObjectId(), "username": f"user{i}", "email": f"user{i}@example.com",
+        "chats": [f"friend{j}@example.com" for j in range(20)], "pp": f"/media/{'0' * 64}",
+    } for i in range(args.items)]
+
+    results = {
+        "messages_legacy": rate(lambda: legacy_render([legacy_serialize_message(m) for m in messages]), args.rounds),
+        "messages_fast": rate(lambda: dumps([serialize_message(m) for m in messages]), args.rounds),
+        "users_legacy": rate(lambda: legacy_render(parse_obj_as(List[UserResponse],
+                                                                [legacy_serialize_user(u) for u in users])),
+                             args.rounds),
+        "users_fast": rate(lambda: dumps([serialize_contact(u) for u in users]), args.rounds),
+    }
+    print(f"orjson: {'yes' if orjson is not None else 'no (stdlib json)'}; {args.items} items per response")
+    for name in ("messages", "users"):
+        legacy, fast = results[f"{name}_legacy"], results[f"{name}_fast"]
+        print(f"/{name}: {legacy:,.0f} -> {fast:,.0f} responses/s ({fast / legacy:.1f}x)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--items", type=int, default=200, help="messages/contacts per response")
+    parser.add_argument("--rounds", type=int, default=200)
+    main(parser.parse_args())
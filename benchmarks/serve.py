@@ -0,0 +1,51 @@
+# benchmarks/serve.py
+"""
+Runs the app against an in-memory MongoDB (mongomock-motor) for load tests,
+with two extra routes the harness reads: event-loop lag and process RSS.
+
+    python benchmarks/serve.py --port 8765
+"""
+import argparse
+import os
+import sys
+import time
+
+os.environ.setdefault("MONGO_URI", "mongomock://")
+# Cheap hashes so seeding thousands of users doesn't dominate the run
+os.environ.setdefault("BCRYPT_ROUNDS", "4")
+os.environ.setdefault("MEDIA_MIGRATE_ON_STARTUP", "0")
+# Per-request INFO logs would dominate the run
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+# Every benchmark client connects from 127.0.0.1 and sends at --rate; measure delivery, not the limiter
+for name in ("RATE_LIMIT_IP_PER_SECOND", "RATE_LIMIT_IP_BURST", "RATE_LIMIT_USER_PER_SECOND", "RATE_LIMIT_USER_BURST"):
+    os.environ.setdefault(name, "1000000")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import uvicorn  # noqa: E402
+
+from main import app  # noqa: E402
+from metrics import loop_lag_monitor, read_rss_bytes  # noqa: E402
+from websocket_config import WS_MAX_FRAME_BYTES  # noqa: E402
+
+# The app's own loop lag monitor, sampling finer than in production and keeping every sample
+loop_lag_monitor.interval = 0.05
+loop_lag_monitor.samples = []
+
+
+@app.get("/__bench__/stats")
+async def bench_stats():
+    return {"loop_lag_seconds": loop_lag_monitor.samples, "rss_bytes": read_rss_bytes(), "time": time.time()}
+
+
+@app.post("/__bench__/reset")
+async def bench_reset():
+    loop_lag_monitor.samples = []
+    return {"detail": "reset"}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning", ws_max_size=WS_MAX_FRAME_BYTES)
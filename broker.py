@@ -0,0 +1,181 @@
+# broker.py
+import asyncio
+import logging
+from os import getenv
+from typing import Awaitable, Callable, Dict, Iterable, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from logging_config import fields
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # Redis is only needed when BROKER_URL points at it
+    aioredis = None
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Empty means single-process delivery; "redis://host:6379/0" fans out across nodes
+BROKER_URL = getenv("BROKER_URL", "")
+PUBLISH_PIPELINE_SIZE = 1000
+
+Handler = Callable[[str, str], Awaitable[None]]
+
+
+def user_channel(email: str) -> str:
+    return f"user:{email}"
+
+
+# A user-channel payload may carry a coalescing key: a newer frame with the same
+# key replaces a still-queued older one (SEND_OVERFLOW_POLICY=coalesce). JSON
+# never starts with this character, so unkeyed payloads need no parsing.
+KEY_SEPARATOR = "\x1e"
+
+
+def keyed_payload(key: str, payload: str) -> str:
+    # Keys can include client-supplied ids; keep the framing intact
+    return f"{KEY_SEPARATOR}{key.replace(KEY_SEPARATOR, '')}{KEY_SEPARATOR}{payload}"
+
+
+def split_key(payload: str) -> Tuple[Optional[str], str]:
+    if not payload.startswith(KEY_SEPARATOR):
+        return None, payload
+    _, key, payload = payload.split(KEY_SEPARATOR, 2)
+    return key, payload
+
+
+class Broker:
+    """
+    Routes payloads published on a channel to whichever node subscribed to it.
+    Each node subscribes to the channels of the users whose sockets it holds,
+    so a publisher never needs to know where the recipient is connected.
+    """
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def publish(self, channel: str, payload: str):
+        raise NotImplementedError
+
+    async def publish_many(self, channels: Iterable[str], payload: str):
+        """Publish one payload to many channels, e.g. every member of a group."""
+        for channel in channels:
+            await self.publish(channel, payload)
+
+    async def subscribe(self, channel: str, handler: Handler):
+        raise NotImplementedError
+
+    async def unsubscribe(self, channel: str):
+        raise NotImplementedError
+
+
+class InProcessBroker(Broker):
+    """Delivers straight to the local handlers; the default for a single worker."""
+
+    def __init__(self):
+        self.handlers: Dict[str, Handler] = {}
+
+    async def publish(self, channel: str, payload: str):
+        handler = self.handlers.get(channel)
+        if handler is not None:
+            await handler(channel, payload)
+
+    async def subscribe(self, channel: str, handler: Handler):
+        self.handlers[channel] = handler
+
+    async def unsubscribe(self, channel: str):
+        self.handlers.pop(channel, None)
+
+
+class RedisBroker(Broker):
+    """
+    Speaks Redis PUBLISH/SUBSCRIBE. Any client exposing the redis.asyncio API
+    works, so tests can hand in a fakeredis instance instead of a server.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.pubsub = client.pubsub()
+        self.handlers: Dict[str, Handler] = {}
+        self.listener: Optional[asyncio.Task] = None
+
+    @classmethod
+    def from_url(cls, url: str):
+        if aioredis is None:
+            raise RuntimeError("BROKER_URL points at Redis but the 'redis' package is not installed")
+        return cls(aioredis.from_url(url, decode_responses=True))
+
+    async def start(self):
+        if self.listener is None:
+            self.listener = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        if self.listener is not None:
+            self.listener.cancel()
+            try:
+                await self.listener
+            except asyncio.CancelledError:
+                pass
+            self.listener = None
+        await self.pubsub.aclose()
+        await self.client.aclose()
+
+    async def publish(self, channel: str, payload: str):
+        await self.client.publish(channel, payload)
+
+    async def publish_many(self, channels: Iterable[str], payload: str):
+        # Pipelined, so a large group costs a handful of round trips, not one per member
+        channels = list(channels)
+        for start in range(0, len(channels), PUBLISH_PIPELINE_SIZE):
+            async with self.client.pipeline(transaction=False) as pipe:
+                for channel in channels[start:start + PUBLISH_PIPELINE_SIZE]:
+                    pipe.publish(channel, payload)
+                await pipe.execute()
+
+    async def subscribe(self, channel: str, handler: Handler):
+        # Register after the SUBSCRIBE went out so the listener never reads too early
+        await self.pubsub.subscribe(channel)
+        self.handlers[channel] = handler
+
+    async def unsubscribe(self, channel: str):
+        if self.handlers.pop(channel, None) is not None:
+            await self.pubsub.unsubscribe(channel)
+
+    async def _listen(self):
+        while True:
+            if not self.handlers:
+                # Nothing subscribed yet, redis-py refuses to read in that state
+                await asyncio.sleep(0.1)
+                continue
+            try:
+                message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Broker listener error: %s", e)
+                await asyncio.sleep(1)
+                continue
+            if not message or message.get("type") != "message":
+                continue
+            channel = message["channel"]
+            handler = self.handlers.get(channel)
+            if handler is None:
+                continue
+            try:
+                await handler(channel, message["data"])
+            except Exception as e:
+                logger.error("Broker handler for %s failed: %s", channel, e, extra=fields(channel=channel))
+
+
+def create_broker(url: str = BROKER_URL) -> Broker:
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisBroker.from_url(url)
+    return InProcessBroker()
+
+
+broker = create_broker()
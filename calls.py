@@ -0,0 +1,194 @@
+# calls.py
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import time
+from datetime import datetime
+from os import getenv
+from typing import Dict, Optional
+
+from dotenv import load_dotenv
+
+from auth import SECRET_KEY
+from broker import broker, user_channel
+from db import call_logs_collection, conversation_key
+from logging_config import fields
+from persistence import WriteBehindQueue
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Keyed so room IDs are stable per pair but can't be derived from two emails alone
+CALL_ROOM_SECRET = getenv("CALL_ROOM_SECRET", SECRET_KEY)
+# A session nobody signalled on for this long is closed and logged
+CALL_SESSION_TTL_SECONDS = int(getenv("CALL_SESSION_TTL_SECONDS", "120"))
+CALL_SWEEP_SECONDS = int(getenv("CALL_SWEEP_SECONDS", "15"))
+
+# Socket message types relayed between the two ends of a call
+CALL_SIGNAL_TYPES = ("call-offer", "call-answer", "ice-candidate", "call-reject", "call-end")
+# Signals that change a call's state; every node hears them so the one logging the call can follow it
+CALL_STATE_TYPES = ("call-offer", "call-answer", "call-reject", "call-end")
+CALLS_CHANNEL = "calls"
+
+
+def call_room_id(a: str, b: str) -> str:
+    """Same two users, same room, whichever of them asks."""
+    return hmac.new(CALL_ROOM_SECRET.encode(), conversation_key(a, b).encode(), hashlib.sha256).hexdigest()[:32]
+
+
+class CallSession:
+    __slots__ = ("room_id", "caller", "callee", "started_at", "answered_at", "last_activity")
+
+    def __init__(self, room_id: str, caller: str, callee: str):
+        self.room_id = room_id
+        self.caller = caller
+        self.callee = callee
+        self.started_at = datetime.utcnow()
+        self.answered_at: Optional[datetime] = None
+        self.last_activity = time.monotonic()
+
+    def other(self, email: str) -> Optional[str]:
+        if email == self.caller:
+            return self.callee
+        if email == self.callee:
+            return self.caller
+        return None
+
+    def log(self, status: str) -> dict:
+        ended_at = datetime.utcnow()
+        return {
+            "roomId": self.room_id,
+            "caller": self.caller,
+            "callee": self.callee,
+            "status": status,
+            "startedAt": self.started_at,
+            "answeredAt": self.answered_at,
+            "endedAt": ended_at,
+            "duration": (ended_at - self.answered_at).total_seconds() if self.answered_at else 0,
+        }
+
+
+class CallManager:
+    """
+    Offers, answers and ICE candidates arrive over the chat socket and are
+    relayed to the other participant through the broker, like chat messages.
+    Relaying is stateless: a signal names its peer in "to" and its roomId must
+    be that pair's, so it works whichever nodes the two ends are connected to.
+
+    The node that relayed the offer keeps the call's session and writes its
+    log; answers, rejects and hang-ups reach it on CALLS_CHANNEL from whichever
+    node handled them. Sessions close on call-end/call-reject or after
+    CALL_SESSION_TTL_SECONDS without signalling; either way one CallLogs entry
+    is queued on a write-behind batch.
+    """
+
+    def __init__(self, ttl: int = CALL_SESSION_TTL_SECONDS, sweep_interval: int = CALL_SWEEP_SECONDS):
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self.sessions: Dict[str, CallSession] = {}
+        self.log_writer = WriteBehindQueue(call_logs_collection)
+        self.sweeper: Optional[asyncio.Task] = None
+        self.expired = 0
+
+    async def start(self):
+        await self.log_writer.start()
+        await broker.subscribe(CALLS_CHANNEL, self._on_broker_message)
+        if self.sweeper is None:
+            self.sweeper = asyncio.create_task(self._sweep())
+
+    async def stop(self):
+        if self.sweeper is not None:
+            self.sweeper.cancel()
+            try:
+                await self.sweeper
+            except asyncio.CancelledError:
+                pass
+            self.sweeper = None
+        await broker.unsubscribe(CALLS_CHANNEL)
+        for session in list(self.sessions.values()):
+            await self._close(session, "interrupted")
+        await self.log_writer.drain()
+
+    def open(self, caller: str, callee: str) -> CallSession:
+        room_id = call_room_id(caller, callee)
+        session = self.sessions.get(room_id)
+        if session is None:
+            session = self.sessions[room_id] = CallSession(room_id, caller, callee)
+        session.last_activity = time.monotonic()
+        return session
+
+    async def signal(self, sender: str, message: dict) -> Optional[str]:
+        """Relay a call signal to the other participant. Returns an error detail if it can't be."""
+        signal_type = message.get("type")
+        room_id = message.get("roomId")
+        recipient = message.get("to")
+        if not recipient:
+            # Replies from older clients carry only the room; that works when the call is held here
+            session = self.sessions.get(str(room_id)) if room_id else None
+            recipient = session.other(sender) if session is not None else None
+            if recipient is None:
+                return "Call signal needs a 'to'"
+        recipient = str(recipient)
+        expected = call_room_id(sender, recipient)
+        if recipient == sender or (room_id and not hmac.compare_digest(str(room_id), expected)):
+            return "Not a participant of this call"
+
+        if signal_type == "call-offer":
+            self.open(sender, recipient)
+        await broker.publish(user_channel(recipient), json.dumps(
+            {**message, "roomId": expected, "from": sender, "to": recipient}, default=str))
+        if signal_type in CALL_STATE_TYPES:
+            await broker.publish(CALLS_CHANNEL, json.dumps({"roomId": expected, "type": signal_type}))
+        else:
+            self._touch(expected)
+        return None
+
+    def _touch(self, room_id: str) -> Optional[CallSession]:
+        session = self.sessions.get(room_id)
+        if session is not None:
+            session.last_activity = time.monotonic()
+        return session
+
+    async def _on_broker_message(self, channel: str, payload: str):
+        event = json.loads(payload)
+        session = self._touch(event["roomId"])
+        if session is None:
+            # Not the node logging this call
+            return
+        signal_type = event["type"]
+        if signal_type == "call-answer" and session.answered_at is None:
+            session.answered_at = datetime.utcnow()
+        elif signal_type in ("call-end", "call-reject"):
+            await self._close(session, "rejected" if signal_type == "call-reject" else
+                              "completed" if session.answered_at else "cancelled")
+
+    async def _close(self, session: CallSession, status: str):
+        if self.sessions.pop(session.room_id, None) is None:
+            return
+        try:
+            await self.log_writer.submit(session.log(status))
+        except RuntimeError:
+            logger.warning("Call log for room %s dropped during shutdown", session.room_id,
+                           extra=fields(room=session.room_id))
+
+    async def _sweep(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                deadline = time.monotonic() - self.ttl
+                for session in [session for session in self.sessions.values() if session.last_activity < deadline]:
+                    await self._close(session, "expired" if session.answered_at else "missed")
+                    self.expired += 1
+            except Exception as e:
+                logger.error("Call session sweep failed: %s", e)
+
+    def stats(self) -> dict:
+        return {"sessions": len(self.sessions), "expired": self.expired, **{
+            f"log_{key}": value for key, value in self.log_writer.stats().items()
+            if key in ("queue_depth", "written", "failed")}}
+
+
+call_manager = CallManager()
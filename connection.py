@@ -0,0 +1,151 @@
+# connection.py
+import asyncio
+import itertools
+import logging
+import time
+from collections import deque
+from os import getenv
+from typing import Dict, Optional
+
+from dotenv import load_dotenv
+from starlette.websockets import WebSocket
+
+from logging_config import fields
+from wire import JsonCodec
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+SEND_QUEUE_SIZE = int(getenv("SEND_QUEUE_SIZE", "256"))
+# What to do when a client can't keep up: "drop" the new frame, "disconnect"
+# the client, or "coalesce" (replace a queued frame with the same key, else
+# drop the oldest one)
+SEND_OVERFLOW_POLICY = getenv("SEND_OVERFLOW_POLICY", "drop")
+SEND_TIMEOUT_SECONDS = float(getenv("SEND_TIMEOUT_SECONDS", "10"))
+
+OVERFLOW_POLICIES = ("drop", "disconnect", "coalesce")
+
+_connection_ids = itertools.count(1)
+
+
+class Connection:
+    """
+    A socket plus its own bounded outbound queue and writer task.
+
+    send() never awaits the network: it only queues the frame, so a slow or
+    stalled client backs up its own queue instead of the sender's receive loop
+    or the delivery to other recipients.
+
+    Frames are encoded with the codec negotiated for this socket; codecs that
+    support it get several queued messages packed into one frame.
+
+    Slotted: a node may hold 100k+ of these.
+    """
+
+    __slots__ = ("id", "websocket", "user_email", "device", "codec", "max_queue", "policy", "send_timeout",
+                 "pending", "keyed", "ready", "closed", "dropped", "connected_at", "last_activity", "writer")
+
+    def __init__(self, websocket: WebSocket, user_email: str, codec=None, max_queue: int = SEND_QUEUE_SIZE,
+                 policy: str = SEND_OVERFLOW_POLICY, send_timeout: float = SEND_TIMEOUT_SECONDS,
+                 device: Optional[str] = None):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown send overflow policy: {policy}")
+        self.id = next(_connection_ids)
+        self.websocket = websocket
+        self.user_email = user_email
+        # Client-chosen id that keys this device's delivery cursor; None for clients that don't send one
+        self.device = device
+        self.codec = codec or JsonCodec()
+        self.max_queue = max_queue
+        self.policy = policy
+        self.send_timeout = send_timeout
+        # Entries are [key, payload] so a coalesced frame can be replaced in place
+        self.pending = deque()
+        self.keyed: Dict[str, list] = {}
+        self.ready = asyncio.Event()
+        self.closed = False
+        self.dropped = 0
+        self.connected_at = self.last_activity = time.monotonic()
+        self.writer = asyncio.create_task(self._write_loop())
+
+    def send(self, payload: str, key: Optional[str] = None) -> bool:
+        """Queue a JSON-encoded message. Returns False if it was not queued."""
+        if self.closed:
+            return False
+        payload = self.codec.item(payload)
+
+        if self.policy == "coalesce" and key is not None and key in self.keyed:
+            self.keyed[key][1] = payload
+            return True
+
+        if len(self.pending) >= self.max_queue:
+            if self.policy == "disconnect":
+                logger.warning("Send queue full for %s, disconnecting slow consumer", self.user_email,
+                               extra=fields(user=self.user_email, device=self.device))
+                self.disconnect(code=1013, reason="Slow consumer")
+                return False
+            if self.policy == "coalesce":
+                oldest_key, _ = self.pending.popleft()
+                if oldest_key is not None:
+                    self.keyed.pop(oldest_key, None)
+            else:
+                self.dropped += 1
+                return False
+            self.dropped += 1
+
+        entry = [key, payload]
+        self.pending.append(entry)
+        if self.policy == "coalesce" and key is not None:
+            self.keyed[key] = entry
+        self.ready.set()
+        return True
+
+    def touch(self):
+        """Record inbound activity; the registry reaps connections idle for too long."""
+        self.last_activity = time.monotonic()
+
+    def disconnect(self, code: int = 1000, reason: str = ""):
+        """Close the socket from outside the receive loop and stop writing."""
+        if self.closed:
+            return
+        self.stop()
+        asyncio.ensure_future(self._close_socket(code, reason))
+
+    def stop(self):
+        self.closed = True
+        self.pending.clear()
+        self.keyed.clear()
+        if not self.writer.done():
+            self.writer.cancel()
+
+    async def _close_socket(self, code: int, reason: str):
+        try:
+            await self.websocket.close(code=code, reason=reason)
+        except Exception:
+            pass  # Already closed by the client
+
+    async def _write_loop(self):
+        while True:
+            while not self.pending:
+                self.ready.clear()
+                await self.ready.wait()
+            items = []
+            while self.pending and len(items) < self.codec.max_batch:
+                key, item = self.pending.popleft()
+                if key is not None:
+                    self.keyed.pop(key, None)
+                items.append(item)
+            try:
+                for frame in self.codec.frames(items):
+                    if self.codec.binary:
+                        await asyncio.wait_for(self.websocket.send_bytes(frame), self.send_timeout)
+                    else:
+                        await asyncio.wait_for(self.websocket.send_text(frame), self.send_timeout)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Error sending message to %s: %r", self.user_email, e,
+                             extra=fields(user=self.user_email, device=self.device))
+                self.disconnect(code=1011, reason="Send failed")
+                return
@@ -0,0 +1,156 @@
+# connection_registry.py
+import asyncio
+import logging
+import sys
+import time
+from os import getenv
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from connection import Connection
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+CONNECTION_REGISTRY_SHARDS = int(getenv("CONNECTION_REGISTRY_SHARDS", "64"))
+# Sockets that sent nothing (not even {"type": "ping"}) for this long are closed; 0 disables
+CONNECTION_IDLE_TIMEOUT_SECONDS = int(getenv("CONNECTION_IDLE_TIMEOUT_SECONDS", "0"))
+CONNECTION_REAP_INTERVAL_SECONDS = int(getenv("CONNECTION_REAP_INTERVAL_SECONDS", "30"))
+# Connections looked at when estimating per-connection memory
+MEMORY_SAMPLE_SIZE = 100
+
+
+def _connection_size(connection: Connection) -> int:
+    """Approximate bytes owned by one connection: the record, its queue and the objects it alone holds."""
+    size = sys.getsizeof(connection) + sys.getsizeof(connection.pending) + sys.getsizeof(connection.keyed)
+    size += sys.getsizeof(connection.ready) + sys.getsizeof(connection.writer)
+    size += sys.getsizeof(connection.websocket) + sys.getsizeof(getattr(connection.websocket, "__dict__", {}))
+    return size + sum(len(item) for _, item in connection.pending)
+
+
+class ConnectionRegistry:
+    """
+    The sockets this node holds, by user. A user may have several (one per
+    device); their entry is a tuple, so the common single-socket case costs
+    one small tuple and delivery iterates it without copying.
+
+    Users are spread over shards so the idle reaper can walk the registry a
+    shard at a time, yielding to the event loop in between, instead of
+    stalling it for one pass over every socket.
+    """
+
+    def __init__(self, shards: int = CONNECTION_REGISTRY_SHARDS, idle_timeout: int = CONNECTION_IDLE_TIMEOUT_SECONDS,
+                 reap_interval: int = CONNECTION_REAP_INTERVAL_SECONDS):
+        self.shards: List[Dict[str, Tuple[Connection, ...]]] = [{} for _ in range(max(1, shards))]
+        self.idle_timeout = idle_timeout
+        self.reap_interval = reap_interval
+        self.connections = 0
+        self.reaped = 0
+        self.reaper: Optional[asyncio.Task] = None
+
+    def _shard(self, email: str) -> Dict[str, Tuple[Connection, ...]]:
+        return self.shards[hash(email) % len(self.shards)]
+
+    def add(self, connection: Connection) -> bool:
+        """Register a socket. Returns True if it is the user's first one on this node."""
+        shard = self._shard(connection.user_email)
+        existing = shard.get(connection.user_email, ())
+        shard[connection.user_email] = existing + (connection,)
+        self.connections += 1
+        return not existing
+
+    def remove(self, connection: Connection) -> bool:
+        """Unregister a socket. Returns True if the user has no sockets left on this node."""
+        shard = self._shard(connection.user_email)
+        existing = shard.get(connection.user_email, ())
+        if connection not in existing:
+            return False
+        remaining = tuple(other for other in existing if other is not connection)
+        self.connections -= 1
+        if remaining:
+            shard[connection.user_email] = remaining
+            return False
+        del shard[connection.user_email]
+        return True
+
+    def get(self, email: str) -> Tuple[Connection, ...]:
+        return self._shard(email).get(email, ())
+
+    def is_connected(self, email: str) -> bool:
+        return email in self._shard(email)
+
+    def __len__(self) -> int:
+        return self.connections
+
+    def users(self) -> int:
+        return sum(len(shard) for shard in self.shards)
+
+    def all(self) -> Iterator[Connection]:
+        for shard in self.shards:
+            for connections in list(shard.values()):
+                yield from connections
+
+    async def start(self):
+        if self.reaper is None:
+            self.reaper = asyncio.create_task(self._reap())
+
+    async def stop(self):
+        if self.reaper is not None:
+            self.reaper.cancel()
+            try:
+                await self.reaper
+            except asyncio.CancelledError:
+                pass
+            self.reaper = None
+
+    async def reap_once(self):
+        now = time.monotonic()
+        for shard in self.shards:
+            for connections in list(shard.values()):
+                for connection in connections:
+                    if connection.closed:
+                        # Stopped without going through the endpoint's cleanup
+                        self.remove(connection)
+                        self.reaped += 1
+                    elif self.idle_timeout and now - connection.last_activity > self.idle_timeout:
+                        connection.disconnect(code=1001, reason="Idle timeout")
+                        self.reaped += 1
+            await asyncio.sleep(0)
+
+    async def _reap(self):
+        while True:
+            await asyncio.sleep(self.reap_interval)
+            try:
+                await self.reap_once()
+            except Exception as e:
+                logger.error("Connection reaping failed: %s", e)
+
+    def stats(self) -> dict:
+        """One pass over the registry; meant for /metrics scrapes, not hot paths."""
+        depth = max_depth = dropped = queued_bytes = 0
+        sample = []
+        for connection in self.all():
+            queued = len(connection.pending)
+            depth += queued
+            max_depth = max(max_depth, queued)
+            dropped += connection.dropped
+            if queued:
+                queued_bytes += sum(len(item) for _, item in connection.pending)
+            if len(sample) < MEMORY_SAMPLE_SIZE:
+                sample.append(connection)
+        return {
+            "connections": self.connections,
+            "users": self.users(),
+            "send_queue_depth": depth,
+            "send_queue_depth_max": max_depth,
+            "send_queued_bytes": queued_bytes,
+            "send_dropped_frames": dropped,
+            "reaped": self.reaped,
+            "approx_bytes_per_connection": (sum(_connection_size(connection) for connection in sample) // len(sample)
+                                            if sample else 0),
+        }
+
+
+connection_registry = ConnectionRegistry()
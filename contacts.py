@@ -0,0 +1,127 @@
+# contacts.py
+import json
+import time
+from bisect import bisect_right
+from collections import OrderedDict
+from os import getenv
+from typing import Dict, List, Optional, Set
+
+from broker import broker
+from db import user_collection, serialize_contact
+
+CONTACT_CACHE_SIZE = int(getenv("CONTACT_CACHE_SIZE", "10000"))
+CONTACT_CACHE_TTL_SECONDS = int(getenv("CONTACT_CACHE_TTL_SECONDS", "300"))
+
+CONTACTS_CHANNEL = "contacts"
+
+# Only what serialize_contact needs; never the password hash
+CONTACT_PROJECTION = {"username": 1, "email": 1, "pp": 1}
+
+
+class ContactCache:
+    """
+    LRU of serialized contact lists keyed by owner, sorted by email.
+
+    A reverse index (contact -> owners whose cached list includes it) lets a
+    change to one user, like a new profile picture, drop exactly the lists
+    that show that user. Changes go through drop()/drop_contact(), which
+    announce them on the broker so every node drops its copy.
+    """
+
+    def __init__(self, max_size: int = CONTACT_CACHE_SIZE, ttl: int = CONTACT_CACHE_TTL_SECONDS):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: "OrderedDict[str, tuple]" = OrderedDict()  # owner -> (expires_at, contacts)
+        self.owners_by_contact: Dict[str, Set[str]] = {}
+
+    async def start(self):
+        await broker.subscribe(CONTACTS_CHANNEL, self._on_broker_message)
+
+    async def stop(self):
+        await broker.unsubscribe(CONTACTS_CHANNEL)
+
+    def get(self, owner: str) -> Optional[List[dict]]:
+        entry = self.entries.get(owner)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            self.invalidate(owner)
+            return None
+        self.entries.move_to_end(owner)
+        return entry[1]
+
+    def put(self, owner: str, contacts: List[dict]):
+        self.invalidate(owner)
+        self.entries[owner] = (time.monotonic() + self.ttl, contacts)
+        for contact in contacts:
+            self.owners_by_contact.setdefault(contact["email"], set()).add(owner)
+        while len(self.entries) > self.max_size:
+            self.invalidate(next(iter(self.entries)))
+
+    def invalidate(self, owner: str):
+        """Drop an owner's list on this node only."""
+        entry = self.entries.pop(owner, None)
+        if entry is None:
+            return
+        for contact in entry[1]:
+            owners = self.owners_by_contact.get(contact["email"])
+            if owners is not None:
+                owners.discard(owner)
+                if not owners:
+                    del self.owners_by_contact[contact["email"]]
+
+    def invalidate_contact(self, email: str):
+        """Drop every cached list on this node that shows this user."""
+        for owner in list(self.owners_by_contact.get(email, ())):
+            self.invalidate(owner)
+
+    async def drop(self, owner: str):
+        """Drop an owner's list everywhere, e.g. after /chats/{email}/join or /deleteuser."""
+        self.invalidate(owner)
+        await broker.publish(CONTACTS_CHANNEL, json.dumps({"owner": owner}))
+
+    async def drop_contact(self, email: str):
+        """Drop every list that shows this user, on every node."""
+        self.invalidate_contact(email)
+        await broker.publish(CONTACTS_CHANNEL, json.dumps({"contact": email}))
+
+    async def _on_broker_message(self, channel: str, payload: str):
+        event = json.loads(payload)
+        if event.get("owner"):
+            self.invalidate(event["owner"])
+        if event.get("contact"):
+            self.invalidate_contact(event["contact"])
+
+
+contact_cache = ContactCache()
+
+
+async def load_contacts(email: str) -> Optional[List[dict]]:
+    """Resolve a user's chats to contact records with one indexed $in lookup."""
+    cached = contact_cache.get(email)
+    if cached is not None:
+        return cached
+
+    user = await user_collection.find_one({"email": email}, {"chats": 1})
+    if not user:
+        return None
+    chats = [str(chat) for chat in user.get("chats", [])]
+    if not chats:
+        contacts = []
+    else:
+        cursor = user_collection.find({"email": {"$in": chats}}, CONTACT_PROJECTION).sort("email", 1)
+        contacts = [serialize_contact(contact) for contact in await cursor.to_list(length=len(chats))]
+    contact_cache.put(email, contacts)
+    return contacts
+
+
+async def get_contacts(email: str, after: Optional[str] = None, limit: Optional[int] = None) -> List[dict]:
+    contacts = await load_contacts(email)
+    if not contacts:
+        return []  # Unknown user or no chats yet
+    if after is not None:
+        # Keyset on email: the list is already sorted by it
+        contacts = contacts[bisect_right(contacts, after, key=lambda contact: contact["email"]):]
+    if limit is not None:
+        contacts = contacts[:limit]
+    return contacts
@@ -1,22 +1,66 @@
 from motor.motor_asyncio import AsyncIOMotorClient
 from bson.objectid import ObjectId
+from pymongo.errors import OperationFailure
 from models import User, Message, PyObjectId
 import logging
+import time
 from os import getenv
 from dotenv import load_dotenv
 from utils import hash_password
+from metrics import mongo_listener
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # MongoDB Configuration
 MONGO_URI = getenv("MONGO_URI", "mongodb://localhost:27017")  # Update with your MongoDB URI if using Atlas
-client = AsyncIOMotorClient(MONGO_URI)
+
+
+def _optional_ms(name: str, default: str = "0"):
+    # 0 means "no limit", which the driver spells None
+    return int(getenv(name, default)) or None
+
+
+# Connection pool and timeouts. Server selection fails after 5s instead of the
+# driver's 30s, so startup and /ready report an unreachable cluster quickly.
+MONGO_CLIENT_OPTIONS = {
+    "maxPoolSize": int(getenv("MONGO_MAX_POOL_SIZE", "100")),
+    "minPoolSize": int(getenv("MONGO_MIN_POOL_SIZE", "0")),
+    "maxIdleTimeMS": _optional_ms("MONGO_MAX_IDLE_TIME_MS"),
+    "maxConnecting": int(getenv("MONGO_MAX_CONNECTING", "2")),
+    # How long a request may wait for a free pooled connection
+    "waitQueueTimeoutMS": _optional_ms("MONGO_WAIT_QUEUE_TIMEOUT_MS"),
+    "serverSelectionTimeoutMS": int(getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000")),
+    "connectTimeoutMS": int(getenv("MONGO_CONNECT_TIMEOUT_MS", "10000")),
+    "socketTimeoutMS": _optional_ms("MONGO_SOCKET_TIMEOUT_MS"),
+}
+if MONGO_URI.startswith("mongomock://"):
+    # In-memory stand-in for benchmarks and local experiments (pip install mongomock-motor)
+    from mongomock_motor import AsyncMongoMockClient
+    client = AsyncMongoMockClient()
+else:
+    client = AsyncIOMotorClient(MONGO_URI, event_listeners=[mongo_listener], **MONGO_CLIENT_OPTIONS)
 db = client["konnectit"]  # Database name
 user_collection = db["usersreg"]
 message_collection = db["messages"]
 # calls_collection = db["calls"]
 call_logs_collection = db['CallLogs']
 group_chat_collection = db["GroupChats"]
+delivery_state_collection = db["DeliveryState"]
+chat_clear_collection = db["ChatClears"]
+inbox_collection = db["Inbox"]
+
+
+def conversation_key(first_email, second_email):
+    # Both directions of a one-to-one chat share the same key, so history
+    # lookups are a single equality match instead of an $or over two shapes.
+    return "|".join(sorted([str(first_email), str(second_email)]))
+
+
+def _text(value) -> str:
+    # Stored fields are almost always str already; skip the str() call for those
+    return value if value.__class__ is str else str(value)
 
 
 def serialize_user(user):
@@ -24,23 +68,131 @@ def serialize_user(user):
         "id": str(user["_id"]),
         "username": user["username"],
         "email": user["email"],
-        "chats": [str(chat) for chat in user.get("chats", [])],
-        "pp": str(user["pp"])
+        "chats": [_text(chat) for chat in user.get("chats", [])],
+        "pp": _text(user["pp"])
     }
 
 
-def serialize_message(message):
+def serialize_contact(user):
+    """The UserResponse shape, built directly so the response needs no model validation."""
     return {
+        "id": str(user["_id"]),
+        "username": _text(user["username"]),
+        "email": _text(user["email"]),
+        "pp": _text(user["pp"]),
+    }
+
+
+# Exactly what serialize_message reads
+MESSAGE_PROJECTION = {"type": 1, "chatId": 1, "content": 1, "timestamp": 1, "sender": 1, "identifier": 1,
+                      "groupId": 1}
+
+
+def serialize_message(message):
+    serialized = {
         "id": str(message["_id"]),
-        "type": str(message["type"]),
-        "chatId": str(message["chatId"]),
-        "content": str(message["content"]),
-        "timestamp": str(message["timestamp"]),
-        "sender": str(message["sender"]),
-        "identifier": message["identifier"],
+        "type": _text(message.get("type", "")),
+        "chatId": _text(message.get("chatId", "")),
+        "content": _text(message.get("content", "")),
+        "timestamp": _text(message.get("timestamp", "")),
+        "sender": _text(message["sender"]),
+        "identifier": message.get("identifier", []),
+    }
+    if "groupId" in message:
+        serialized["groupId"] = _text(message["groupId"])
+    return serialized
+
+
+def serialize_group(group):
+    return {
+        "id": str(group["_id"]),
+        "chatName": group["chatName"],
+        "participants": group.get("participants", []),
+        "owner": group.get("owner"),
     }
 
 
+async def backfill_conversation_keys():
+    # Messages written before the "conversation" field existed get it derived
+    # from sender/chatId in place, so no document has to leave the server.
+    result = await message_collection.update_many(
+        {"conversation": {"$exists": False}, "sender": {"$type": "string"}, "chatId": {"$type": "string"}},
+        [{"$set": {"conversation": {"$cond": [
+            {"$lt": ["$sender", "$chatId"]},
+            {"$concat": ["$sender", "|", "$chatId"]},
+            {"$concat": ["$chatId", "|", "$sender"]},
+        ]}}}]
+    )
+    if result.modified_count:
+        logger.info("Backfilled conversation key on %d messages", result.modified_count)
+
+
+# Every query shape the app runs, as (collection, keys, options). create_index
+# is a no-op for an index that already exists with the same spec, so this is
+# safe to run on every start.
+INDEXES = [
+    # Logins, token checks and contact $in lookups all resolve users by email
+    (user_collection, "email", {"unique": True, "name": "email_unique"}),
+    # Keyset pagination walks (conversation, timestamp, _id) in either direction
+    (message_collection, [("conversation", 1), ("timestamp", -1), ("_id", -1)],
+     {"name": "conversation_timestamp_id"}),
+    # Group replay, exports after a watermark and compaction: a conversation's messages by _id
+    (message_collection, [("conversation", 1), ("_id", 1)], {"name": "conversation_id"}),
+    # Offline replay: messages addressed to a user after their last-acked id
+    (message_collection, [("chatId", 1), ("_id", 1)], {"name": "chatId_id"}),
+    # Device sync: what the user sent from their other devices since a device's cursor
+    (message_collection, [("sender", 1), ("_id", 1)], {"name": "sender_id"}),
+    # Message search: conversation-prefixed so each query only reads one conversation's postings.
+    # Language "none" indexes words as typed (no stemming or stop words), as chats mix languages
+    (message_collection, [("conversation", 1), ("content", "text")],
+     {"name": "conversation_content_text", "default_language": "none"}),
+    # One delivery cursor per (user, device); device is null for clients that don't name one
+    (delivery_state_collection, [("email", 1), ("device", 1)], {"unique": True, "name": "email_device_unique"}),
+    # Per-user "cleared before" watermarks, and the compactor's work list
+    (chat_clear_collection, [("email", 1), ("conversation", 1)], {"unique": True, "name": "email_conversation_unique"}),
+    (chat_clear_collection, [("conversation", 1)], {"name": "conversation"}),
+    (chat_clear_collection, [("pending_compaction", 1)],
+     {"name": "pending_compaction", "partialFilterExpression": {"pending_compaction": True}}),
+    # Groups a user belongs to
+    (group_chat_collection, "participants", {"name": "participants"}),
+    # One summary per (user, conversation); the inbox lists them newest first
+    (inbox_collection, [("email", 1), ("conversation", 1)], {"unique": True, "name": "email_conversation_unique"}),
+    (inbox_collection, [("email", 1), ("last.id", -1)], {"name": "email_last_id"}),
+    # A user's call history, newest first, from either side of the call
+    (call_logs_collection, [("caller", 1), ("startedAt", -1)], {"name": "caller_startedAt"}),
+    (call_logs_collection, [("callee", 1), ("startedAt", -1)], {"name": "callee_startedAt"}),
+]
+
+# Superseded indexes that would get in the way of the ones above, as (collection, name)
+RETIRED_INDEXES = [
+    # Unique per user; delivery cursors are per device now
+    (delivery_state_collection, "email_unique"),
+]
+
+
+async def ensure_indexes():
+    """
+    Drop retired indexes, create any missing one, then backfill. An index
+    that can't be built (duplicate emails, an older index with other options
+    under the same name) is logged and skipped rather than failing startup;
+    connection errors still propagate.
+    """
+    started = time.perf_counter()
+    for collection, name in RETIRED_INDEXES:
+        if name in await collection.index_information():
+            await collection.drop_index(name)
+            logger.info("Dropped retired index %s.%s", collection.name, name)
+    failed = 0
+    for collection, keys, options in INDEXES:
+        try:
+            await collection.create_index(keys, **options)
+        except OperationFailure as e:
+            failed += 1
+            logger.error("Could not create index %s.%s: %s", collection.name, options["name"], e)
+    await backfill_conversation_keys()
+    logger.info("Ensured %d/%d indexes in %.2fs", len(INDEXES) - failed, len(INDEXES), time.perf_counter() - started)
+
+
 async def seed_users():
     # Example users
     users = [
@@ -69,6 +221,6 @@ async def seed_users():
         existing_user = await user_collection.find_one({"email": user["email"]})
         if not existing_user:
             await user_collection.insert_one(user)
-            logging.info(f"Inserted user: {user['email']}")
+            logger.info("Inserted user: %s", user["email"])
 
-    logging.info("Seeding complete")
\ No newline at end of file
+    logger.info("Seeding complete")
\ No newline at end of file
@@ -0,0 +1,158 @@
+# delivery.py
+import asyncio
+import json
+import logging
+from os import getenv
+from typing import Dict, List, Optional, Tuple
+
+from bson import ObjectId
+from dotenv import load_dotenv
+from pymongo import UpdateOne
+
+from db import message_collection, delivery_state_collection, group_chat_collection, chat_clear_collection
+from groups import group_conversation_key
+from logging_config import fields
+from persistence import message_writer
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+REPLAY_BATCH_SIZE = int(getenv("REPLAY_BATCH_SIZE", "200"))
+# Past this many missed messages the client is told to page /messages instead
+REPLAY_MAX_MESSAGES = int(getenv("REPLAY_MAX_MESSAGES", "2000"))
+DELIVERY_FLUSH_INTERVAL_MS = int(getenv("DELIVERY_FLUSH_INTERVAL_MS", "1000"))
+
+
+def parse_message_id(value) -> Optional[ObjectId]:
+    if isinstance(value, ObjectId):
+        return value
+    if isinstance(value, str) and ObjectId.is_valid(value):
+        return ObjectId(value)
+    return None
+
+
+class DeliveryTracker:
+    """
+    Per-device delivery cursor: the highest message _id a device of the user
+    has acknowledged. Clients that don't name a device (device None) share
+    one cursor per user, as before devices existed.
+
+    Message ids are ObjectIds assigned at ingest, so they double as the
+    delivery sequence. Acks only move the cursor forward and are buffered in
+    memory, then written with one bulk $max upsert per flush interval rather
+    than a write per receipt.
+    """
+
+    def __init__(self, flush_interval_ms: int = DELIVERY_FLUSH_INTERVAL_MS):
+        self.flush_interval = flush_interval_ms / 1000
+        self.pending: Dict[Tuple[str, Optional[str]], ObjectId] = {}
+        self.task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await self.flush()
+
+    def ack(self, email: str, message_id: ObjectId, device: Optional[str] = None):
+        key = (email, device)
+        current = self.pending.get(key)
+        if current is None or message_id > current:
+            self.pending[key] = message_id
+
+    async def cursor(self, email: str, device: Optional[str] = None) -> Optional[ObjectId]:
+        # device None also matches cursors stored before there was a device field
+        state = await delivery_state_collection.find_one({"email": email, "device": device}, {"acked": 1})
+        stored = state.get("acked") if state else None
+        buffered = self.pending.get((email, device))
+        if stored is None or (buffered is not None and buffered > stored):
+            return buffered
+        return stored
+
+    async def flush(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        try:
+            await delivery_state_collection.bulk_write([
+                UpdateOne({"email": email, "device": device}, {"$max": {"acked": acked}}, upsert=True)
+                for (email, device), acked in pending.items()
+            ], ordered=False)
+        except Exception as e:
+            logger.error("Failed to store delivery cursors: %s", e)
+            # Keep them for the next round; newer acks win
+            for (email, device), acked in pending.items():
+                self.ack(email, acked, device)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+
+delivery_tracker = DeliveryTracker()
+
+
+async def missed_messages(email: str, since: ObjectId, limit: int, include_own: bool = False) -> List[dict]:
+    """
+    Messages addressed to the user after `since`. With include_own, also what
+    the user sent in that time, i.e. from their other devices. Anything the
+    user cleared is left out, as in /messages.
+    """
+    # Anything still in the write-behind queue has to land before we look
+    await message_writer.sync()
+    groups = await group_chat_collection.find({"participants": email}, {"_id": 1}).to_list(length=None)
+    addressed = [{"chatId": email}]
+    if groups:
+        addressed.append({
+            "conversation": {"$in": [group_conversation_key(str(group["_id"])) for group in groups]},
+            "sender": {"$ne": email},
+        })
+    if include_own:
+        addressed.append({"sender": email})
+    query = {"$or": addressed, "_id": {"$gt": since}}
+    # Only watermarks past the cursor can hide anything from this replay
+    clears = await chat_clear_collection.find(
+        {"email": email, "before": {"$gt": since}}, {"conversation": 1, "before": 1}
+    ).to_list(length=None)
+    if clears:
+        query["$nor"] = [{"conversation": clear["conversation"], "_id": {"$lte": clear["before"]}}
+                         for clear in clears]
+    return await message_collection.find(query).sort("_id", 1).limit(limit).to_list(length=limit)
+
+
+async def replay(connection, email: str, since: Optional[ObjectId] = None):
+    """
+    Send what a reconnecting device missed since its cursor, as a few batched
+    frames instead of one frame per message. A named device also gets the
+    messages the user sent from elsewhere (including its own sends it never
+    acked, which clients drop by id). Devices that never acked anything get
+    no replay; they load history through /messages as before.
+    """
+    if since is None:
+        since = await delivery_tracker.cursor(email, connection.device)
+        if since is None:
+            return
+    messages = await missed_messages(email, since, REPLAY_MAX_MESSAGES + 1, include_own=connection.device is not None)
+    truncated = len(messages) > REPLAY_MAX_MESSAGES
+    messages = messages[:REPLAY_MAX_MESSAGES]
+    for start in range(0, len(messages), REPLAY_BATCH_SIZE):
+        batch = messages[start:start + REPLAY_BATCH_SIZE]
+        connection.send(json.dumps({
+            "type": "replay",
+            "messages": batch,
+            "more": start + REPLAY_BATCH_SIZE < len(messages),
+        }, default=str))
+    if truncated:
+        connection.send(json.dumps({"type": "replay_truncated", "since": str(messages[-1]["_id"])}))
+    logger.info("Replayed %d missed messages to %s", len(messages), email,
+                extra=fields(user=email, device=connection.device))
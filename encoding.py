@@ -0,0 +1,64 @@
+# encoding.py
+import json
+from os import getenv
+from typing import Any, Iterator, List, Optional
+
+from dotenv import load_dotenv
+from starlette.responses import Response, StreamingResponse
+
+try:
+    import orjson
+except ImportError:  # Falls back to the standard library encoder
+    orjson = None
+
+load_dotenv()
+
+# Lists longer than this are streamed in chunks instead of encoded in one piece
+JSON_STREAM_THRESHOLD = int(getenv("JSON_STREAM_THRESHOLD", "1000"))
+JSON_STREAM_CHUNK = 500
+
+
+def dumps(content: Any) -> bytes:
+    """JSON-encode to bytes; anything the encoder doesn't know (ObjectId, datetime) becomes str()."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(content, default=str)
+        except TypeError:
+            pass  # e.g. integers beyond 64 bits, which json handles
+    return json.dumps(content, default=str, separators=(",", ":"), ensure_ascii=False).encode()
+
+
+def dumps_str(content: Any) -> str:
+    return dumps(content).decode()
+
+
+class FastJSONResponse(Response):
+    """Encodes with dumps() and nothing else: no jsonable_encoder, no response_model validation."""
+
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+def _stream_array(items: List[Any]) -> Iterator[bytes]:
+    yield b"["
+    for start in range(0, len(items), JSON_STREAM_CHUNK):
+        chunk = dumps(items[start:start + JSON_STREAM_CHUNK])[1:-1]
+        if start and chunk:
+            yield b","
+        yield chunk
+    yield b"]"
+
+
+def json_response(content: Any, response: Optional[Response] = None) -> Response:
+    """
+    The fast path for endpoints returning already-serialized dicts. Headers
+    set on the injected `response` (cursors, X-Has-More) are carried over,
+    since FastAPI doesn't merge them into a Response the endpoint returns.
+    """
+    headers = {key: value for key, value in response.headers.items() if key != "content-length"} \
+        if response is not None else None
+    if isinstance(content, list) and len(content) > JSON_STREAM_THRESHOLD:
+        return StreamingResponse(_stream_array(content), media_type="application/json", headers=headers)
+    return FastJSONResponse(content, headers=headers)
@@ -0,0 +1,90 @@
+# export.py
+import logging
+from os import getenv
+from typing import AsyncIterator, Optional
+
+from bson import ObjectId
+from dotenv import load_dotenv
+from fastapi import HTTPException
+from starlette.responses import StreamingResponse
+
+from db import message_collection, serialize_message, MESSAGE_PROJECTION
+from encoding import dumps
+from get_messages import encode_cursor, cursor_filter
+from logging_config import fields
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Documents per Motor round trip, and messages per chunk written to the client
+EXPORT_BATCH_SIZE = int(getenv("EXPORT_BATCH_SIZE", "500"))
+EXPORT_CHUNK_MESSAGES = int(getenv("EXPORT_CHUNK_MESSAGES", "100"))
+
+EXPORT_FORMATS = ("ndjson", "sse")
+
+
+async def _export_lines(conversation: str, export_format: str, resume: Optional[str],
+                        visible_after: Optional[ObjectId]) -> AsyncIterator[bytes]:
+    query = {"conversation": conversation}
+    if visible_after is not None:
+        query["_id"] = {"$gt": visible_after}
+    if resume:
+        query.update(cursor_filter(resume, "$gt"))
+    # Same (conversation, timestamp, _id) index as /messages, oldest first
+    cursor = message_collection.find(query, MESSAGE_PROJECTION).sort(
+        [("timestamp", 1), ("_id", 1)]
+    ).batch_size(EXPORT_BATCH_SIZE)
+
+    chunk = []
+    count = 0
+    try:
+        async for message in cursor:
+            token = encode_cursor(message)
+            if export_format == "sse":
+                # EventSource sends the last id back as Last-Event-ID when it reconnects
+                chunk.append(b"id: " + token.encode() + b"\nevent: message\ndata: " +
+                             dumps(serialize_message(message)) + b"\n\n")
+            else:
+                chunk.append(dumps({**serialize_message(message), "cursor": token}) + b"\n")
+            count += 1
+            if len(chunk) >= EXPORT_CHUNK_MESSAGES:
+                yield b"".join(chunk)
+                chunk = []
+    except Exception as e:
+        # Headers are gone already; end the stream without the trailer so the client resumes
+        logger.error("Export of %s failed after %d messages: %s", conversation, count, e,
+                     extra=fields(conversation=conversation))
+        if chunk:
+            yield b"".join(chunk)
+        return
+    finally:
+        await cursor.close()
+
+    trailer = dumps({"type": "export_end", "count": count})
+    if export_format == "sse":
+        chunk.append(b"event: end\ndata: " + trailer + b"\n\n")
+    else:
+        chunk.append(trailer + b"\n")
+    yield b"".join(chunk)
+
+
+def export_conversation(conversation: str, export_format: str = "ndjson", resume: Optional[str] = None,
+                        visible_after: Optional[ObjectId] = None, filename: str = "conversation") -> StreamingResponse:
+    """
+    Stream a whole conversation with constant memory. NDJSON lines carry a
+    "cursor"; SSE events carry it as their id. Passing the last one back as
+    `resume` continues right after that message. A final export_end record
+    tells a complete export from a cut-off one.
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(EXPORT_FORMATS)}")
+    if resume:
+        cursor_filter(resume, "$gt")  # Reject a bad token before the stream starts
+    if export_format == "sse":
+        return StreamingResponse(_export_lines(conversation, export_format, resume, visible_after),
+                                 media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    return StreamingResponse(_export_lines(conversation, export_format, resume, visible_after),
+                             media_type="application/x-ndjson",
+                             headers={"Content-Disposition": f'attachment; filename="{filename}.ndjson"'})
@@ -1,9 +1,8 @@
 from fastapi import Query, HTTPException
-from jose import jwt, JWTError
+from jose import JWTError
 from starlette import status
 
-from auth import SECRET_KEY, ALGORITHM
-from db import user_collection
+from auth import get_verified_user
 
 
 async def get_current_user(token: str = Query(...)):
@@ -13,11 +12,8 @@ async def get_current_user(token: str = Query(...)):
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email: str = payload.get("sub")
-        if email is None:
-            raise credentials_exception
-        user = await user_collection.find_one({"email": email})
+        # Served from the verified-token cache; Mongo is only hit on a miss
+        user = await get_verified_user(token)
         if user is None:
             raise credentials_exception
         return user
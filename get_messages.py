@@ -1,25 +1,106 @@
+import base64
+import json
 import logging
+from typing import Optional
 
-from fastapi import Depends, HTTPException
+from bson import ObjectId
+from fastapi import Depends, HTTPException, Response
 from pydantic import EmailStr
 
-from db import message_collection, serialize_message
+from db import message_collection, serialize_message, conversation_key, MESSAGE_PROJECTION
 from get_current_user import get_current_user
+from history import cleared_before
+from logging_config import fields
 from models import User
 
+logger = logging.getLogger(__name__)
 
-async def get_messages(chatId: EmailStr, sender_email: EmailStr, current_user: User = Depends(get_current_user)):
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+def encode_cursor(message):
+    # Opaque keyset position: the (timestamp, _id) pair of a message
+    raw = json.dumps([message.get("timestamp"), str(message["_id"])])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor: str):
     try:
-        logging.info(f"Fetching messages for chatId={chatId} and sender_email={sender_email}")
-        messages = await message_collection.find({
-            "$or": [
-                {"chatId": chatId, "sender": sender_email},
-                {"chatId": sender_email, "sender": chatId}
-            ]
-        }).to_list(length=None)
+        timestamp, message_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return timestamp, ObjectId(message_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def cursor_filter(cursor: str, op: str):
+    timestamp, message_id = decode_cursor(cursor)
+    if timestamp is None:
+        # Legacy messages without a timestamp sort before every stamped one
+        if op == "$lt":
+            return {"timestamp": None, "_id": {op: message_id}}
+        return {"$or": [
+            {"timestamp": {"$ne": None}},
+            {"timestamp": None, "_id": {op: message_id}}
+        ]}
+    older_or_newer = [
+        {"timestamp": {op: timestamp}},
+        {"timestamp": timestamp, "_id": {op: message_id}}
+    ]
+    if op == "$lt":
+        older_or_newer.append({"timestamp": None})
+    return {"$or": older_or_newer}
+
+
+async def get_messages(chatId: EmailStr, sender_email: EmailStr, current_user: User = Depends(get_current_user),
+                       response: Response = None, before: Optional[str] = None, after: Optional[str] = None,
+                       limit: int = DEFAULT_PAGE_SIZE):
+    logger.debug("Fetching messages for %s and %s", chatId, sender_email)
+    conversation = conversation_key(chatId, sender_email)
+    # Hide whatever the caller cleared with /deletechathistory
+    visible_after = await cleared_before(current_user["email"], conversation) if current_user else None
+    return await get_conversation_page(conversation, response, before, after, limit, visible_after)
+
+
+async def get_conversation_page(conversation: str, response: Response = None, before: Optional[str] = None,
+                                after: Optional[str] = None, limit: int = DEFAULT_PAGE_SIZE,
+                                visible_after: Optional[ObjectId] = None):
+    """One keyset page of a conversation (one-to-one or group), oldest message first."""
+    if before and after:
+        raise HTTPException(status_code=400, detail="Use either 'before' or 'after', not both")
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+    query = {"conversation": conversation}
+    if visible_after is not None:
+        query["_id"] = {"$gt": visible_after}
+    if after:
+        # Newer than the cursor, oldest first
+        query.update(cursor_filter(after, "$gt"))
+        direction = 1
+    else:
+        # Latest page (or older than the cursor), newest first then flipped
+        if before:
+            query.update(cursor_filter(before, "$lt"))
+        direction = -1
+
+    try:
+        messages = await message_collection.find(query, MESSAGE_PROJECTION).sort(
+            [("timestamp", direction), ("_id", direction)]
+        ).limit(limit + 1).to_list(length=limit + 1)
+        has_more = len(messages) > limit
+        messages = messages[:limit]
+        if direction == -1:
+            messages.reverse()
+
         serialized_messages = [serialize_message(msg) for msg in messages]
-        logging.debug(f"Fetched messages: {serialized_messages}")
-        return serialized_messages
+        logger.debug("Fetched %d messages (has_more=%s)", len(serialized_messages), has_more)
+
+        if response is not None:
+            response.headers["X-Has-More"] = "true" if has_more else "false"
+            if messages:
+                response.headers["X-Before-Cursor"] = encode_cursor(messages[0])
+                response.headers["X-After-Cursor"] = encode_cursor(messages[-1])
     except Exception as e:
-        logging.error(f"Error fetching messages: {e}")
+        logger.error("Error fetching messages: %s", e, extra=fields(conversation=conversation))
         raise HTTPException(status_code=500, detail=f"Error fetching messages: {e}")
+    return serialized_messages
@@ -0,0 +1,134 @@
+# groups.py
+import json
+import logging
+from collections import OrderedDict
+from os import getenv
+from typing import FrozenSet, List, Optional
+
+from bson import ObjectId
+from fastapi import HTTPException
+
+from broker import broker
+from db import group_chat_collection, serialize_group
+
+logger = logging.getLogger(__name__)
+
+GROUP_CACHE_SIZE = int(getenv("GROUP_CACHE_SIZE", "10000"))
+
+GROUPS_CHANNEL = "groups"
+
+
+def group_conversation_key(group_id: str) -> str:
+    # Group history is stored once per message under this key, not per member
+    return f"group:{group_id}"
+
+
+def parse_group_id(group_id) -> ObjectId:
+    if not ObjectId.is_valid(group_id):
+        raise HTTPException(status_code=404, detail="Group not found")
+    return ObjectId(group_id)
+
+
+class GroupMembership:
+    """
+    In-memory LRU of group id -> member set, loaded on first use.
+
+    Fan-out and permission checks read from here instead of GroupChats. Any
+    membership change is announced on the broker so every node drops its copy.
+    """
+
+    def __init__(self, max_size: int = GROUP_CACHE_SIZE):
+        self.max_size = max_size
+        self.members: "OrderedDict[str, FrozenSet[str]]" = OrderedDict()
+
+    async def start(self):
+        await broker.subscribe(GROUPS_CHANNEL, self._on_broker_message)
+
+    async def stop(self):
+        await broker.unsubscribe(GROUPS_CHANNEL)
+
+    async def members_of(self, group_id: str) -> Optional[FrozenSet[str]]:
+        members = self.members.get(group_id)
+        if members is not None:
+            self.members.move_to_end(group_id)
+            return members
+        if not ObjectId.is_valid(group_id):
+            return None
+        group = await group_chat_collection.find_one({"_id": ObjectId(group_id)}, {"participants": 1})
+        if group is None:
+            return None
+        members = frozenset(group.get("participants", []))
+        self.members[group_id] = members
+        if len(self.members) > self.max_size:
+            self.members.popitem(last=False)
+        return members
+
+    async def invalidate(self, group_id: str):
+        self.members.pop(group_id, None)
+        await broker.publish(GROUPS_CHANNEL, json.dumps({"groupId": group_id}))
+
+    async def _on_broker_message(self, channel: str, payload: str):
+        self.members.pop(json.loads(payload)["groupId"], None)
+
+
+group_membership = GroupMembership()
+
+
+async def create_group(chat_name: str, participants: List[str], creator: str) -> dict:
+    members = sorted(set(participants) | {creator})
+    # The creator owns the group: only they add or remove other members
+    group = {"chatName": chat_name, "participants": members, "owner": creator}
+    result = await group_chat_collection.insert_one(group)
+    logger.info("Group %s created by %s with %d members", result.inserted_id, creator, len(members))
+    return serialize_group({**group, "_id": result.inserted_id})
+
+
+async def get_user_groups(email: str) -> List[dict]:
+    groups = await group_chat_collection.find(
+        {"participants": email}, {"chatName": 1, "participants": 1, "owner": 1}
+    ).to_list(length=None)
+    return [serialize_group(group) for group in groups]
+
+
+async def require_member(group_id: str, email: str) -> FrozenSet[str]:
+    members = await group_membership.members_of(group_id)
+    if members is None:
+        raise HTTPException(status_code=404, detail="Group not found")
+    if email not in members:
+        raise HTTPException(status_code=403, detail="Not a member of this group")
+    return members
+
+
+async def require_owner(group_id: str, email: str):
+    await require_member(group_id, email)
+    group = await group_chat_collection.find_one({"_id": parse_group_id(group_id)}, {"owner": 1})
+    if group is None:
+        raise HTTPException(status_code=404, detail="Group not found")
+    if group.get("owner") != email:
+        raise HTTPException(status_code=403, detail="Only the group owner can do this")
+
+
+async def add_members(group_id: str, participants: List[str], current_user: str) -> dict:
+    await require_owner(group_id, current_user)
+    await group_chat_collection.update_one(
+        {"_id": parse_group_id(group_id)},
+        {"$addToSet": {"participants": {"$each": list(participants)}}}
+    )
+    await group_membership.invalidate(group_id)
+    return {"detail": "Members added"}
+
+
+async def remove_member(group_id: str, email: str, current_user: str) -> dict:
+    if email == current_user:
+        # Anyone may leave
+        await require_member(group_id, current_user)
+    else:
+        await require_owner(group_id, current_user)
+    result = await group_chat_collection.update_one(
+        {"_id": parse_group_id(group_id)},
+        {"$pull": {"participants": email}}
+    )
+    if result.modified_count == 0:
+        return {"detail": "User not in group"}
+    await group_membership.invalidate(group_id)
+    return {"detail": f"{email} removed from group"}
@@ -0,0 +1,110 @@
+# history.py
+import asyncio
+import logging
+from os import getenv
+from typing import Optional
+
+from bson import ObjectId
+from dotenv import load_dotenv
+
+from db import message_collection, chat_clear_collection, conversation_key
+from inbox import clear_summary
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+COMPACTION_INTERVAL_SECONDS = int(getenv("COMPACTION_INTERVAL_SECONDS", "300"))
+COMPACTION_BATCH_SIZE = int(getenv("COMPACTION_BATCH_SIZE", "500"))
+# Pause between delete batches so compaction never hogs the database
+COMPACTION_BATCH_PAUSE_MS = int(getenv("COMPACTION_BATCH_PAUSE_MS", "100"))
+
+
+async def clear_history(email: str, chat_id: str) -> bool:
+    """
+    Hide everything in the conversation from `email` by moving their
+    "cleared before" watermark to now. Constant work regardless of history
+    size; returns False if the conversation has no messages at all.
+    """
+    conversation = conversation_key(email, chat_id)
+    if await message_collection.find_one({"conversation": conversation}, {"_id": 1}) is None:
+        return False
+    await chat_clear_collection.update_one(
+        {"email": email, "conversation": conversation},
+        {"$max": {"before": ObjectId()}, "$set": {"pending_compaction": True}},
+        upsert=True
+    )
+    await clear_summary(email, conversation)
+    return True
+
+
+async def cleared_before(email: str, conversation: str) -> Optional[ObjectId]:
+    clear = await chat_clear_collection.find_one({"email": email, "conversation": conversation}, {"before": 1})
+    return clear["before"] if clear else None
+
+
+class HistoryCompactor:
+    """
+    Deletes messages that every participant has cleared, i.e. older than the
+    lowest watermark of the conversation, in small throttled batches.
+    Only conversations with a new watermark since the last pass are looked at.
+    """
+
+    def __init__(self, interval: int = COMPACTION_INTERVAL_SECONDS, batch_size: int = COMPACTION_BATCH_SIZE,
+                 batch_pause_ms: int = COMPACTION_BATCH_PAUSE_MS):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause_ms / 1000
+        self.task: Optional[asyncio.Task] = None
+        self.deleted = 0
+
+    async def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def compact_once(self):
+        conversations = await chat_clear_collection.distinct("conversation", {"pending_compaction": True})
+        for conversation in conversations:
+            participants = conversation.split("|")
+            clears = await chat_clear_collection.find(
+                {"conversation": conversation}, {"email": 1, "before": 1}
+            ).to_list(length=None)
+            cleared_by = {clear["email"]: clear["before"] for clear in clears}
+            if len(participants) == 2 and all(participant in cleared_by for participant in participants):
+                await self._delete_before(conversation, min(cleared_by.values()))
+            for clear in clears:
+                # A clear that moved on while we worked keeps its flag for the next pass
+                await chat_clear_collection.update_one(
+                    {"_id": clear["_id"], "before": clear["before"]}, {"$unset": {"pending_compaction": ""}}
+                )
+
+    async def _delete_before(self, conversation: str, before: ObjectId):
+        while True:
+            batch = await message_collection.find(
+                {"conversation": conversation, "_id": {"$lt": before}}, {"_id": 1}
+            ).limit(self.batch_size).to_list(length=self.batch_size)
+            if not batch:
+                return
+            result = await message_collection.delete_many({"_id": {"$in": [message["_id"] for message in batch]}})
+            self.deleted += result.deleted_count
+            await asyncio.sleep(self.batch_pause)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.compact_once()
+            except Exception as e:
+                logger.error("History compaction failed: %s", e)
+
+
+history_compactor = HistoryCompactor()
@@ -0,0 +1,126 @@
+# inbox.py
+import logging
+from os import getenv
+from typing import Dict, List, Optional, Tuple
+
+from bson import ObjectId
+from dotenv import load_dotenv
+from pymongo import UpdateOne
+
+from db import inbox_collection, conversation_key
+from groups import group_membership, group_conversation_key
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+INBOX_PREVIEW_LENGTH = int(getenv("INBOX_PREVIEW_LENGTH", "100"))
+INBOX_MAX_LIMIT = 500
+
+
+def _preview(message: dict) -> dict:
+    return {
+        "id": message["_id"],
+        "type": str(message.get("type", "")),
+        "sender": message["sender"],
+        "preview": str(message.get("content", ""))[:INBOX_PREVIEW_LENGTH],
+        "timestamp": str(message.get("timestamp", "")),
+    }
+
+
+async def _participants(message: dict) -> Optional[Tuple[str, str, List[str]]]:
+    """(conversation, peer field, everyone whose inbox shows it) for a persisted message."""
+    if message.get("groupId"):
+        members = await group_membership.members_of(str(message["groupId"]))
+        if not members:
+            return None
+        return group_conversation_key(str(message["groupId"])), "groupId", list(members)
+    if message.get("chatId"):
+        chat_id = str(message["chatId"])
+        return message.get("conversation") or conversation_key(message["sender"], chat_id), "chatId", \
+            [message["sender"], chat_id]
+    return None
+
+
+async def record_messages(messages: List[dict]):
+    """
+    Flush listener of the message writer: fold a batch of persisted messages
+    into one upsert per (user, conversation) holding the latest message and
+    how many of them the user didn't send. Messages at or below the user's
+    read_up_to don't count as unread, as a read receipt may be handled before
+    the flush of the message it acknowledges (here or on another node).
+    """
+    summaries: Dict[Tuple[str, str], dict] = {}
+    for message in messages:
+        participants = await _participants(message)
+        if participants is None:
+            continue
+        conversation, peer_field, emails = participants
+        for email in emails:
+            summary = summaries.get((email, conversation))
+            if summary is None:
+                peer = message["groupId"] if peer_field == "groupId" else \
+                    (message["chatId"] if email == message["sender"] else message["sender"])
+                summary = summaries[(email, conversation)] = {"peer_field": peer_field, "peer": str(peer),
+                                                              "last": None, "unread": []}
+            if summary["last"] is None or message["_id"] > summary["last"]["id"]:
+                summary["last"] = _preview(message)
+            if email != message["sender"]:
+                summary["unread"].append(message["_id"])
+    if not summaries:
+        return
+
+    operations = []
+    for (email, conversation), summary in summaries.items():
+        last = summary["last"]
+        operations.append(UpdateOne({"email": email, "conversation": conversation}, [{"$set": {
+            summary["peer_field"]: summary["peer"],
+            "unread": {"$add": [{"$ifNull": ["$unread", 0]}, {"$size": {"$filter": {
+                "input": {"$literal": summary["unread"]},
+                "cond": {"$gt": ["$$this", {"$ifNull": ["$read_up_to", None]}]},
+            }}}]},
+            # Batches from different nodes may land out of order; only a newer message replaces the preview
+            "last": {"$cond": [{"$gt": [last["id"], {"$ifNull": ["$last.id", None]}]},
+                               {"$literal": last}, "$last"]},
+        }}], upsert=True))
+    await inbox_collection.bulk_write(operations, ordered=False)
+
+
+async def mark_read(email: str, conversation: str, message_id: ObjectId):
+    """
+    Move the user's read_up_to forward. A read receipt up to the latest
+    message also clears the unread counter. The upsert keeps the cursor even
+    when the message's own summary update hasn't been flushed yet.
+    """
+    await inbox_collection.update_one({"email": email, "conversation": conversation}, [{"$set": {
+        "read_up_to": {"$max": [{"$ifNull": ["$read_up_to", None]}, message_id]},
+        "unread": {"$cond": [{"$lte": [{"$ifNull": ["$last.id", None]}, message_id]},
+                             0, {"$ifNull": ["$unread", 0]}]},
+    }}], upsert=True)
+
+
+async def clear_summary(email: str, conversation: str):
+    """After /deletechathistory the conversation stays listed, but empty."""
+    await inbox_collection.update_one({"email": email, "conversation": conversation},
+                                      {"$set": {"unread": 0, "last": None}})
+
+
+def serialize_summary(summary: dict) -> dict:
+    last = summary.get("last")
+    serialized = {
+        "conversation": summary["conversation"],
+        "unread": summary.get("unread", 0),
+        "lastMessage": {**last, "id": str(last["id"])} if last else None,
+    }
+    for peer_field in ("chatId", "groupId"):
+        if peer_field in summary:
+            serialized[peer_field] = summary[peer_field]
+    return serialized
+
+
+async def get_inbox(email: str, limit: int = 100) -> List[dict]:
+    """The user's conversations, most recent message first, from one indexed query."""
+    # Entries only a read receipt has touched so far have no "last" yet (cleared ones have last: None)
+    cursor = inbox_collection.find({"email": email, "last": {"$exists": True}},
+                                   {"_id": 0, "email": 0, "read_up_to": 0}).sort("last.id", -1).limit(limit)
+    return [serialize_summary(summary) for summary in await cursor.to_list(length=limit)]
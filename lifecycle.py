@@ -0,0 +1,171 @@
+# lifecycle.py
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from os import getenv
+from typing import List, Tuple
+
+from dotenv import load_dotenv
+
+from auth import token_cache
+from broker import broker
+from calls import call_manager
+from connection_registry import connection_registry
+from contacts import contact_cache, load_contacts
+from db import client, ensure_indexes, message_collection
+from delivery import delivery_tracker
+from groups import group_membership
+from history import history_compactor
+from media import migrate_profile_pictures, MEDIA_MIGRATE_ON_STARTUP
+from metrics import loop_lag_monitor
+from persistence import message_writer
+from presence import presence
+from utils import password_hasher
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Load contact lists and group members of recently active users before serving
+PREWARM_ON_STARTUP = getenv("PREWARM_ON_STARTUP", "0") == "1"
+# Newest messages whose senders and groups count as "recently active"
+PREWARM_MESSAGES = int(getenv("PREWARM_MESSAGES", "2000"))
+PREWARM_CONCURRENCY = 8
+# How long shutdown waits for closed sockets to finish their cleanup
+SHUTDOWN_DRAIN_SECONDS = float(getenv("SHUTDOWN_DRAIN_SECONDS", "10"))
+READINESS_TIMEOUT_SECONDS = float(getenv("READINESS_TIMEOUT_SECONDS", "2"))
+
+
+class Lifecycle:
+    """
+    Starts the app's background services in dependency order and stops them
+    in reverse. Shutdown first flips readiness off and closes every socket
+    (clients reconnect elsewhere and replay from their cursor), then flushes
+    the write-behind queues while Mongo and the broker are still there.
+    """
+
+    def __init__(self):
+        self.started = False
+        self.draining = False
+        self.background: List[asyncio.Task] = []
+
+    async def startup(self):
+        started = time.perf_counter()
+        await ensure_indexes()
+        await broker.start()
+        await message_writer.start()
+        await delivery_tracker.start()
+        await group_membership.start()
+        await contact_cache.start()
+        await token_cache.start()
+        await history_compactor.start()
+        await presence.start()
+        await call_manager.start()
+        await connection_registry.start()
+        await loop_lag_monitor.start()
+        if MEDIA_MIGRATE_ON_STARTUP:
+            # Legacy inline pictures keep working until moved
+            self.background.append(asyncio.create_task(migrate_profile_pictures()))
+        if PREWARM_ON_STARTUP:
+            await self.prewarm()
+        self.started = True
+        logger.info("Startup complete in %.2fs", time.perf_counter() - started)
+
+    async def prewarm(self, messages: int = PREWARM_MESSAGES):
+        """Fill the contact and group caches for whoever sent the newest messages."""
+        started = time.perf_counter()
+        senders, groups = set(), set()
+        try:
+            async for message in message_collection.find({}, {"sender": 1, "groupId": 1}).sort(
+                    "_id", -1).limit(messages):
+                senders.add(str(message["sender"]))
+                if message.get("groupId"):
+                    groups.add(str(message["groupId"]))
+        except Exception as e:
+            logger.warning("Cache prewarm skipped: %s", e)
+            return
+        semaphore = asyncio.Semaphore(PREWARM_CONCURRENCY)
+
+        async def warm(load, key):
+            async with semaphore:
+                try:
+                    await load(key)
+                except Exception as e:
+                    logger.warning("Could not prewarm %s: %s", key, e)
+
+        await asyncio.gather(*(warm(load_contacts, email) for email in senders),
+                             *(warm(group_membership.members_of, group_id) for group_id in groups))
+        logger.info("Prewarmed %d contact lists and %d groups in %.2fs",
+                    len(senders), len(groups), time.perf_counter() - started)
+
+    async def drain_connections(self, timeout: float = SHUTDOWN_DRAIN_SECONDS):
+        connections = list(connection_registry.all())
+        if not connections:
+            return
+        logger.info("Closing %d WebSocket connections", len(connections))
+        for connection in connections:
+            # 1001 "going away": clients reconnect and replay what they missed
+            connection.disconnect(code=1001, reason="Server shutting down")
+        # Each endpoint unregisters its socket and updates presence as it exits
+        deadline = time.monotonic() + timeout
+        while len(connection_registry) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if len(connection_registry):
+            logger.warning("%d connections still open after %ss", len(connection_registry), timeout)
+
+    async def shutdown(self):
+        self.draining = True
+        for task in self.background:
+            task.cancel()
+        await self.drain_connections()
+        # Each step runs even if an earlier one failed; a lost flush is logged, not fatal
+        steps = [
+            ("loop lag monitor", loop_lag_monitor.stop),
+            ("connection reaper", connection_registry.stop),
+            # Queue logs of calls still open, then flush them
+            ("call manager", call_manager.stop),
+            # Flush queued messages (and their inbox updates) before the broker and Mongo go away
+            ("message writer", message_writer.drain),
+            ("delivery tracker", delivery_tracker.stop),
+            ("presence", presence.stop),
+            ("history compactor", history_compactor.stop),
+            ("token cache", token_cache.stop),
+            ("contact cache", contact_cache.stop),
+            ("group membership", group_membership.stop),
+            ("broker", broker.stop),
+        ]
+        for name, stop in steps:
+            try:
+                await stop()
+            except Exception as e:
+                logger.error("Stopping %s failed: %s", name, e)
+        password_hasher.shutdown()
+        client.close()
+        self.started = False
+        logger.info("Shutdown complete")
+
+    async def readiness(self) -> Tuple[bool, dict]:
+        """Ready once startup finished, until shutdown begins, while Mongo answers a ping."""
+        checks = {"startup": "complete" if self.started else "pending"}
+        if self.draining:
+            checks["startup"] = "draining"
+        try:
+            await asyncio.wait_for(client.admin.command("ping"), READINESS_TIMEOUT_SECONDS)
+            checks["mongo"] = "ok"
+        except Exception as e:
+            checks["mongo"] = f"unavailable: {e.__class__.__name__}"
+        ready = self.started and not self.draining and checks["mongo"] == "ok"
+        return ready, {"status": "ready" if ready else "unavailable", "checks": checks}
+
+
+lifecycle = Lifecycle()
+
+
+@asynccontextmanager
+async def lifespan(app):
+    await lifecycle.startup()
+    try:
+        yield
+    finally:
+        await lifecycle.shutdown()
@@ -0,0 +1,137 @@
+# logging_config.py
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+from os import getenv
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+LOG_LEVEL = getenv("LOG_LEVEL", "INFO")
+# Per-module overrides, e.g. "websocket_config=DEBUG,presence=WARNING,httpx=WARNING"
+LOG_LEVELS = getenv("LOG_LEVELS", "")
+# "text" (key=value fields) or "json" (one object per line)
+LOG_FORMAT = getenv("LOG_FORMAT", "text")
+# Fraction of sampled per-message records that are kept
+LOG_SAMPLE_RATE = float(getenv("LOG_SAMPLE_RATE", "0.01"))
+LOG_QUEUE_SIZE = int(getenv("LOG_QUEUE_SIZE", "10000"))
+
+
+def sampled(**fields) -> dict:
+    """
+    `extra` for per-message records, e.g. logger.debug("Broadcast to %d users", n, extra=sampled(chat=chat_id)).
+    Only LOG_SAMPLE_RATE of them are written.
+    """
+    return {"fields": fields, "sampled": True}
+
+
+def fields(**values) -> dict:
+    """
+    `extra` carrying structured fields. Values may be zero-argument callables;
+    they are only called if the record is actually written.
+    """
+    return {"fields": values}
+
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, rate: float = LOG_SAMPLE_RATE):
+        super().__init__()
+        self.rate = rate
+        self.dropped = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if getattr(record, "sampled", False) and random.random() >= self.rate:
+            self.dropped += 1
+            return False
+        return True
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to the listener thread without waiting: the caller only
+    resolves the message and lazy fields; formatting and I/O happen off the
+    event loop. When the queue is full the record is dropped and counted.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        values = getattr(record, "fields", None)
+        if values:
+            record.fields = {key: value() if callable(value) else value for key, value in values.items()}
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class StructuredFormatter(logging.Formatter):
+    def __init__(self, json_lines: bool = False):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+        self.json_lines = json_lines
+
+    def format(self, record: logging.LogRecord) -> str:
+        values = getattr(record, "fields", None) or {}
+        if self.json_lines:
+            entry = {"time": self.formatTime(record), "level": record.levelname, "logger": record.name,
+                     "message": record.getMessage(), **values}
+            if record.exc_text:
+                entry["exc"] = record.exc_text
+            return json.dumps(entry, default=str)
+        line = super().format(record)
+        if values:
+            line += " " + " ".join(f"{key}={value}" for key, value in values.items())
+        return line
+
+
+_listener = None
+sampling_filter = SamplingFilter()
+
+
+def configure_logging():
+    """Route all logging through a queue drained by one background thread. Safe to call more than once."""
+    global _listener
+    if _listener is not None:
+        return
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(sampling_filter)
+
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(StructuredFormatter(json_lines=LOG_FORMAT == "json"))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(LOG_LEVEL.upper())
+    for override in filter(None, (item.strip() for item in LOG_LEVELS.split(","))):
+        name, _, level = override.partition("=")
+        logging.getLogger(name.strip()).setLevel(level.strip().upper())
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Flush what is queued and stop the listener thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -5,13 +5,20 @@ from fastapi import HTTPException
 from auth import create_access_token
 from db import user_collection, serialize_user
 from schemas import UserLogin
-from utils import verify_password
+from utils import password_hasher
 
 
 async def login_user(user: UserLogin):
     db_user = await user_collection.find_one({"email": user.email})
-    if not db_user or not verify_password(user.password, db_user["hashed_password"]):
+    if not db_user:
         raise HTTPException(status_code=401, detail="Invalid email or password")
+    # bcrypt runs in the hasher pool, off the event loop
+    valid, new_hash = await password_hasher.verify_and_update(user.password, db_user["hashed_password"])
+    if not valid:
+        raise HTTPException(status_code=401, detail="Invalid email or password")
+    if new_hash:
+        # Cost parameters changed since this hash was made; upgrade it in place
+        await user_collection.update_one({"_id": db_user["_id"]}, {"$set": {"hashed_password": new_hash}})
 
     # Generate JWT token
     access_token_expires = timedelta(minutes=60)
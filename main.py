@@ -1,29 +1,50 @@
 # main.py
-import asyncio
+import json
 import logging
-from datetime import datetime
-from typing import List, Dict
+from typing import List, Optional
 
-from fastapi import FastAPI, HTTPException, WebSocket, Depends, Query
+from fastapi import FastAPI, HTTPException, WebSocket, Depends, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import EmailStr
 from sse_starlette import EventSourceResponse
 from starlette import status
 
-from db import user_collection, serialize_user, message_collection, serialize_message
+from auth import token_cache
+from calls import call_manager, call_room_id
+from connection_registry import connection_registry
+from contacts import contact_cache, get_contacts, load_contacts
+from db import user_collection, conversation_key
+from encoding import json_response, FastJSONResponse
+from export import export_conversation
 from get_current_user import get_current_user
-from get_messages import get_messages
+from get_messages import get_messages, get_conversation_page, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from logging_config import configure_logging, fields
 from login_user import login_user
-from models import User, ChangePPRequest, GroupChat
+from lifecycle import lifecycle, lifespan
+from metrics import MetricsMiddleware, register_stats, render as render_metrics, \
+    CONTENT_TYPE as METRICS_CONTENT_TYPE
+from media import store_profile_picture, serve_media
+from groups import create_group, get_user_groups, add_members, remove_member, require_member, \
+    group_conversation_key
+from history import clear_history, cleared_before
+from inbox import record_messages, get_inbox, INBOX_MAX_LIMIT
+from models import User, ChangePPRequest, GroupChat, GroupMembersRequest
+from persistence import message_writer
+from presence import presence, PRESENCE_MAX_WATCHED
+from rate_limit import user_limiter, ip_limiter
 from register_user import register_user
 from schemas import UserResponse, UserCreate, UserLogin
+from search import search_messages, SEARCH_MAX_LIMIT
+from utils import password_hasher
 from validate_token_endpoint import validate_token_endpoint
-from websocket_config import websocket_endpoint, user_status
+from websocket_config import websocket_endpoint, WS_MAX_FRAME_BYTES
 
-app = FastAPI()
+logger = logging.getLogger(__name__)
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+app = FastAPI(lifespan=lifespan)
+
+# Configure logging (LOG_LEVEL / LOG_LEVELS / LOG_SAMPLE_RATE)
+configure_logging()
 
 # CORS configuration
 origins = [
@@ -38,21 +59,46 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Before-Cursor", "X-After-Cursor", "X-Has-More", "X-Next-Offset"],
 )
+app.add_middleware(MetricsMiddleware)
+
+# Conversation summaries follow every persisted batch
+message_writer.add_flush_listener(record_messages)
+
+register_stats("message_writer", message_writer.stats)
+register_stats("password_hasher", password_hasher.stats)
+register_stats("token_cache", token_cache.stats)
+register_stats("websocket", connection_registry.stats)
+register_stats("calls", call_manager.stats)
+register_stats("rate_limit_user", user_limiter.stats)
+register_stats("rate_limit_ip", ip_limiter.stats)
 
 # @app.on_event("startup")
 # async def startup_event():
 #     await seed_users()
 
-active_connections: Dict[EmailStr, WebSocket] = {}
-# user_status: Dict[EmailStr, dict] = {}  # Tracks online status and last seen time
-active_webrtc_connections: Dict[str, WebSocket] = {}
-webrtc_sessions: Dict[str, Dict[EmailStr, bool]] = {}
+
+@app.get("/health")
+async def health():
+    # Liveness: the process is up and its event loop answers
+    return {"status": "ok"}
+
+
+@app.get("/ready")
+async def ready():
+    is_ready, report = await lifecycle.readiness()
+    return FastJSONResponse(report, status_code=200 if is_ready else 503)
+
+
+@app.get("/metrics")
+async def metrics():
+    return Response(render_metrics(), media_type=METRICS_CONTENT_TYPE)
 
 
 @app.post("/register", response_model=UserResponse)
-async def register(user: UserCreate):
-    return await register_user(user)
+async def register(user: UserCreate, http_request: Request):
+    return await register_user(user, str(http_request.base_url))
 
 
 @app.post("/login")
@@ -66,71 +112,80 @@ async def validate_token(token: str = Query(...)):
 
 
 @app.websocket("/ws/{token}")
-async def websocket_communication(websocket: WebSocket, token: str):
-    return await websocket_endpoint(websocket, token)
+async def websocket_communication(websocket: WebSocket, token: str, since: Optional[str] = Query(None),
+                                  device: Optional[str] = Query(None)):
+    return await websocket_endpoint(websocket, token, since, device)
 
 
 # @app.websocket("/webrtc/{token}")
 # async def webrtc_websocket_connection(websocket: WebSocket, token: str):
 #     await webrtc_websocket_endpoint(websocket, token)
 
-call_connections = []
-
-
 # @app.get("/calllogs/{}/{}/{}/{}/{}")
 
 @app.get("/room/{sender}/{receiver}")
 async def room_id(sender: EmailStr, receiver: EmailStr):
-    # Print the sender and receiver for debugging
-    print(sender, receiver)
-
-    # Sort the sender and receiver to ensure the order is consistent
+    # The pair's call room; signalling then goes over /ws and the call is tracked from its offer
     sorted_users = sorted([sender, receiver])
-
-    # Check if both sender and receiver are in the call_connections list
-    for people in sorted_users:
-        if people not in call_connections:
-            call_connections.append(people)
-
-    # Return concatenated details in sorted order
-    return {
-        "detail": f"{call_connections[call_connections.index(sorted_users[0])]} + {call_connections[call_connections.index(sorted_users[1])]}"}
+    return {"detail": f"{sorted_users[0]} + {sorted_users[1]}", "roomId": call_room_id(sender, receiver)}
 
 
 @app.get("/user-status/{email}")
 async def get_user_status(email: EmailStr):
     """API to get a user's online status and last seen time."""
-    logging.debug(f"User Status=> {user_status}")
-    if email in user_status:
-        stats = user_status[email]
-        logging.debug(f"Stats=> {stats}")
-        return {
-            "online": stats["online"],
-            "last_seen": stats["last_seen"].isoformat() if stats["last_seen"] else None,
-        }
-    else:
+    stats = presence.get(email)
+    if stats is None:
         raise HTTPException(status_code=404, detail="User not found")
+    return stats
 
 
 @app.get("/sse/user-status/{email}")
 async def sse_user_status(email: EmailStr):
     async def event_generator():
-        while True:
-            if email not in user_status:
-                yield {
-                    "data": "User not found",
-                    "event": "error",
-                }
-                break
-            stats = user_status[email]
+        stats = presence.get(email)
+        if stats is None:
             yield {
-                "data": {
-                    "online": stats["online"],
-                    "last_seen": stats["last_seen"].isoformat() if stats["last_seen"] else None,
-                },
-                "event": "status_update",
+                "data": "User not found",
+                "event": "error",
             }
-            await asyncio.sleep(5)  # Send an update every 5 seconds
+            return
+        # Current state once, then only pushed changes
+        updates = presence.subscribe([email])
+        try:
+            yield {"data": stats, "event": "status_update"}
+            while True:
+                delta = await updates.get()
+                yield {
+                    "data": {"online": delta["online"], "last_seen": delta["last_seen"]},
+                    "event": "status_update",
+                }
+        finally:
+            presence.unsubscribe(updates, [email])
+
+    return EventSourceResponse(event_generator())
+
+
+@app.get("/sse/users-status")
+async def sse_users_status(emails: List[EmailStr] = Query(...), current_user: dict = Depends(get_current_user)):
+    """One stream for a whole contact list: a snapshot per known user, then deltas."""
+    if len(emails) > PRESENCE_MAX_WATCHED:
+        raise HTTPException(status_code=400, detail=f"At most {PRESENCE_MAX_WATCHED} users per stream")
+    # Only the caller's own contacts can be watched
+    contacts = await load_contacts(current_user["email"]) or []
+    watched = set(emails) & {contact["email"] for contact in contacts}
+
+    async def event_generator():
+        updates = presence.subscribe(watched)
+        try:
+            for email in watched:
+                stats = presence.get(email)
+                if stats is not None:
+                    yield {"data": json.dumps({"email": email, **stats}), "event": "status_update"}
+            while True:
+                delta = await updates.get()
+                yield {"data": json.dumps(delta), "event": "status_update"}
+        finally:
+            presence.unsubscribe(updates, watched)
 
     return EventSourceResponse(event_generator())
 
@@ -138,19 +193,83 @@ async def sse_user_status(email: EmailStr):
 @app.post("/logout/{email}")
 async def logout_user(email: EmailStr):
     """API to update a user's last seen time on logout."""
-    if email in user_status:
-        user_status[email]["online"] = False
-        user_status[email]["last_seen"] = datetime.now()
-        logging.debug(f"Updated user {email} last seen time: {user_status[email]['last_seen']}")
-
-        return {"detail": "Successfully logged out"}
-    else:
+    await token_cache.drop_user(email)
+    if presence.get(email) is None:
         raise HTTPException(status_code=404, detail="User not found")
+    await presence.logged_out(email)
+    logger.debug("Updated user %s last seen time", email)
+    return {"detail": "Successfully logged out"}
 
 
 @app.get("/messages/{chatId}/{sender_email}")
-async def messages(chatId: EmailStr, sender_email: EmailStr, current_user: User = Depends(get_current_user)):
-    return await get_messages(chatId, sender_email, current_user)
+async def messages(chatId: EmailStr, sender_email: EmailStr, response: Response,
+                   before: Optional[str] = Query(None), after: Optional[str] = Query(None),
+                   limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                   current_user: User = Depends(get_current_user)):
+    return json_response(await get_messages(chatId, sender_email, current_user, response, before, after, limit),
+                         response)
+
+
+@app.get("/export/{chatId}")
+async def export_chat(chatId: EmailStr, request: Request, format: str = Query("ndjson"),
+                      resume: Optional[str] = Query(None), current_user: dict = Depends(get_current_user)):
+    # EventSource reconnects send the last event id instead of ?resume=
+    conversation = conversation_key(current_user["email"], chatId)
+    visible_after = await cleared_before(current_user["email"], conversation)
+    return export_conversation(conversation, format, resume or request.headers.get("last-event-id"), visible_after)
+
+
+@app.get("/groups/{group_id}/export")
+async def export_group(group_id: str, request: Request, format: str = Query("ndjson"),
+                       resume: Optional[str] = Query(None), current_user: dict = Depends(get_current_user)):
+    await require_member(group_id, current_user["email"])
+    return export_conversation(group_conversation_key(group_id), format,
+                               resume or request.headers.get("last-event-id"), filename=f"group-{group_id}")
+
+
+@app.get("/inbox")
+async def inbox(limit: int = Query(100, ge=1, le=INBOX_MAX_LIMIT), current_user: dict = Depends(get_current_user)):
+    # The sidebar in one request: last message and unread count per conversation
+    return json_response(await get_inbox(current_user["email"], limit))
+
+
+@app.get("/search")
+async def search(response: Response, q: str = Query(..., min_length=1), chatId: Optional[EmailStr] = Query(None),
+                 groupId: Optional[str] = Query(None), limit: int = Query(20, ge=1, le=SEARCH_MAX_LIMIT),
+                 offset: int = Query(0, ge=0), current_user: dict = Depends(get_current_user)):
+    return json_response(await search_messages(current_user["email"], q, response, chatId, groupId, limit, offset),
+                         response)
+
+
+@app.post("/groups")
+async def new_group(group: GroupChat, current_user: dict = Depends(get_current_user)):
+    return await create_group(group.chatName, group.participants, current_user["email"])
+
+
+@app.get("/groups")
+async def list_groups(current_user: dict = Depends(get_current_user)):
+    return await get_user_groups(current_user["email"])
+
+
+@app.post("/groups/{group_id}/members")
+async def add_group_members(group_id: str, request: GroupMembersRequest,
+                            current_user: dict = Depends(get_current_user)):
+    return await add_members(group_id, request.participants, current_user["email"])
+
+
+@app.delete("/groups/{group_id}/members/{email}")
+async def remove_group_member(group_id: str, email: EmailStr, current_user: dict = Depends(get_current_user)):
+    return await remove_member(group_id, email, current_user["email"])
+
+
+@app.get("/groups/{group_id}/messages")
+async def group_messages(group_id: str, response: Response,
+                         before: Optional[str] = Query(None), after: Optional[str] = Query(None),
+                         limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                         current_user: dict = Depends(get_current_user)):
+    await require_member(group_id, current_user["email"])
+    return json_response(await get_conversation_page(group_conversation_key(group_id), response, before, after,
+                                                     limit), response)
 
 
 # @app.get("/users", response_model=List[UserResponse])
@@ -161,26 +280,30 @@ async def messages(chatId: EmailStr, sender_email: EmailStr, current_user: User
 #     return [serialize_user(user) for user in users]
 
 @app.post("/change-pp")
-async def change_pp(request: ChangePPRequest):
+async def change_pp(request: ChangePPRequest, http_request: Request):
     x = await validate_token_endpoint(request.token)
     if not x.get("isValid"):
-        logging.error("Invalid token")
+        logger.error("Invalid token")
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid token",
             headers={"WWW-Authenticate": "Bearer"},
         )
 
-    # Find the user by email
-    user = await user_collection.find_one({"email": request.email})
-    if not user:
-        return {"detail": "User doesn't exist!"}
+    try:
+        pp = await store_profile_picture(request.pp, str(http_request.base_url))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid profile picture: {e}")
 
-    # Update the user's profile picture
+    # Update the user's profile picture; matched_count doubles as the existence check
     result = await user_collection.update_one(
         {"email": request.email},
-        {"$set": {"pp": request.pp}}
+        {"$set": {"pp": pp}}
     )
+    if result.matched_count == 0:
+        return {"detail": "User doesn't exist!"}
+    await token_cache.drop_user(request.email)
+    await contact_cache.drop_contact(request.email)
 
     if result.modified_count == 1:
         return {"detail": "Profile picture updated successfully!"}
@@ -188,11 +311,16 @@ async def change_pp(request: ChangePPRequest):
         return {"detail": "Failed to update profile picture or no changes made."}
 
 
+@app.get("/media/{digest}")
+async def get_media(digest: str, request: Request, size: Optional[int] = Query(None)):
+    return await serve_media(digest, request, size)
+
+
 @app.get("/own-user-info/{email}")
 async def own_user(email: EmailStr):
     user = await user_collection.find_one(({
         "email": email
-    }))  # Return an empty list if the user is not found
+    }), {"username": 1, "email": 1, "pp": 1})  # Return an empty list if the user is not found
 
     # Convert the "_id" field to a string for the found user
     user["_id"] = str(user["_id"])
@@ -206,35 +334,21 @@ async def own_user(email: EmailStr):
 
 
 @app.get("/users/{email}", response_model=List[UserResponse])
-async def get_users(email: EmailStr):
-    # Fetch the user with the specified email
-    user = await user_collection.find_one({"email": email})
-    if not user:
-        return []  # Return an empty list if the user is not found
-
-    # Convert the "_id" field to a string for the found user
-    user["_id"] = str(user["_id"])
-
-    # Fetch all users from the collection
-    additional_chat_users = await user_collection.find({}).to_list(length=None)
-
-    # Filter and serialize users whose email matches any chats in the user's "chats"
-    return [
-        serialize_user(chat_user)
-        for chat_user in additional_chat_users
-        if any(chat in chat_user['email'] for chat in user.get('chats', []))
-    ]
+async def get_users(email: EmailStr, after: Optional[EmailStr] = Query(None),
+                    limit: Optional[int] = Query(None, ge=1, le=500)):
+    # Contacts of the user with the specified email, cached and paged by email. Already in the
+    # UserResponse shape, so the model is only documentation and the list is encoded as is
+    return json_response(await get_contacts(email, after, limit))
 
 
 @app.post("/chats/{email}/join")
 async def join_chat(email: EmailStr, chat_data: dict, current_user: User = Depends(get_current_user)):
-    logging.debug(f"Sender: {email}, Chat Data: {chat_data}")
-    print(f"Sender: {email}, Chat Data: {chat_data}")
+    logger.debug("Join chat", extra=fields(sender=email, chat_id=chat_data.get("chatId")))
     try:
         chat_id = chat_data.get("chatId")
         if not chat_id:
             raise HTTPException(status_code=400, detail="Chat ID is required")
-        user_check = await user_collection.find({"email": chat_id}).to_list(length=None)
+        user_check = await user_collection.find_one({"email": chat_id}, {"_id": 1})
         if not user_check:
             return {"detail": "User Not Found"}
 
@@ -244,42 +358,23 @@ async def join_chat(email: EmailStr, chat_data: dict, current_user: User = Depen
         )
         if result.modified_count == 0:
             return {"detail": "User already in chat"}
+        await contact_cache.drop(email)
         return {"detail": "Chat joined successfully"}
     except Exception as e:
-        logging.error(f"Error joining chat: {e}")
+        logger.error("Error joining chat: %s", e, extra=fields(user=email))
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.delete("/deletechathistory/{email}/{chatId}/")
 async def delete_email_from_identifier(email: EmailStr, chatId: EmailStr):
-    # Find documents where:
-    # 1. The identifier array contains both `email` and `chatId`
-    query = {"$or": [
-        {"chatId": chatId, "sender": email},
-        {"chatId": email, "sender": chatId}
-    ]}
-
-    # Check if matching documents exist
-    documents = await message_collection.find(query).to_list(length=None)
-
-    if not documents:
+    # Only moves `email`'s "cleared before" watermark; the messages themselves
+    # are removed later by the compactor once both sides have cleared them
+    if not await clear_history(email, chatId):
         raise HTTPException(
             status_code=404,
             detail="No Chats found!"
         )
 
-    # Remove the `email` from the identifier array in matching documents
-    update_result = await message_collection.update_many(
-        query,
-        {"$pull": {"identifier": email}}
-    )
-
-    if update_result.modified_count == 0:
-        raise HTTPException(
-            status_code=400,
-            detail="Failed to remove email from identifier."
-        )
-
     return {"detail": "Chat History Cleared!"}
 
 
@@ -298,6 +393,7 @@ async def delete_user(email: EmailStr, current_user: EmailStr):
 
     if result.modified_count == 0:
         return {"detail": "Email not found in chats"}
+    await contact_cache.drop(current_user)
 
     return {"detail": f"Email {email} removed from chats successfully"}
 
@@ -305,4 +401,4 @@ async def delete_user(email: EmailStr, current_user: EmailStr):
 if __name__ == "__main__":
     import uvicorn
 
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run(app, host="0.0.0.0", port=8000, ws_max_size=WS_MAX_FRAME_BYTES)
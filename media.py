@@ -0,0 +1,267 @@
+# media.py
+import asyncio
+import base64
+import binascii
+import hashlib
+import io
+import logging
+import os
+import re
+from os import getenv
+from typing import Optional, Tuple
+
+from dotenv import load_dotenv
+from fastapi import HTTPException, Request, Response
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+
+from db import db, user_collection
+
+try:
+    from PIL import Image
+except ImportError:  # Thumbnails are optional; originals are served without Pillow
+    Image = None
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# "local" keeps files under MEDIA_DIR, "gridfs" keeps them in the konnectit database
+MEDIA_BACKEND = getenv("MEDIA_BACKEND", "local")
+MEDIA_DIR = getenv("MEDIA_DIR", "media")
+# Prefix for the URLs stored on user records, e.g. "https://api.example.com". Unset, the
+# origin the upload came in on is used, and the startup migration is skipped
+MEDIA_BASE_URL = getenv("MEDIA_BASE_URL", "")
+MEDIA_MAX_BYTES = int(getenv("MEDIA_MAX_BYTES", str(5 * 1024 * 1024)))
+THUMBNAIL_SIZES = (32, 64, 128, 256)
+# Move inline data URLs left on existing users into the store at startup
+MEDIA_MIGRATE_ON_STARTUP = getenv("MEDIA_MIGRATE_ON_STARTUP", "1") == "1"
+
+DATA_URL_PATTERN = re.compile(r"^data:(?P<type>[\w/+.-]+)?(;[\w=.-]+)*;base64,(?P<data>.*)$", re.DOTALL)
+DIGEST_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+# Served back from the API origin, so only raster types browsers won't run as a page (no SVG)
+ALLOWED_IMAGE_TYPES = ("image/png", "image/jpeg", "image/gif", "image/webp")
+
+
+def parse_data_url(data_url: str) -> Tuple[str, bytes]:
+    match = DATA_URL_PATTERN.match(data_url)
+    if not match:
+        raise ValueError("Not a base64 data URL")
+    content_type = (match.group("type") or "").lower()
+    if content_type not in ALLOWED_IMAGE_TYPES:
+        raise ValueError(f"Image type must be one of {', '.join(ALLOWED_IMAGE_TYPES)}")
+    try:
+        data = base64.b64decode(match.group("data"), validate=True)
+    except (binascii.Error, ValueError):
+        raise ValueError("Invalid base64 image data")
+    if len(data) > MEDIA_MAX_BYTES:
+        raise ValueError("Image too large")
+    return content_type, data
+
+
+def media_url(digest: str, base_url: Optional[str] = None) -> str:
+    # Stored on the user record and handed to every client, so it has to be absolute
+    base_url = MEDIA_BASE_URL or base_url
+    if not base_url:
+        raise RuntimeError("Media URLs need MEDIA_BASE_URL or the request's base URL")
+    return f"{base_url.rstrip('/')}/media/{digest}"
+
+
+class MediaStore:
+    """Content-addressed blobs: the key is the SHA-256 of the bytes, so duplicates are stored once."""
+
+    async def put(self, data: bytes, content_type: str, key: Optional[str] = None) -> str:
+        raise NotImplementedError
+
+    async def get(self, key: str) -> Optional[Tuple[bytes, str]]:
+        raise NotImplementedError
+
+    async def exists(self, key: str) -> bool:
+        raise NotImplementedError
+
+
+class LocalMediaStore(MediaStore):
+    def __init__(self, root: str = MEDIA_DIR):
+        self.root = root
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key)
+
+    def _write(self, key: str, data: bytes, content_type: str):
+        path = self._path(key)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename so readers never see a half-written file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(content_type.encode() + b"\n" + data)
+        os.replace(tmp_path, path)
+
+    def _read(self, key: str) -> Optional[Tuple[bytes, str]]:
+        try:
+            with open(self._path(key), "rb") as f:
+                content_type, _, data = f.read().partition(b"\n")
+        except FileNotFoundError:
+            return None
+        return data, content_type.decode()
+
+    async def put(self, data: bytes, content_type: str, key: Optional[str] = None) -> str:
+        key = key or hashlib.sha256(data).hexdigest()
+        await asyncio.to_thread(self._write, key, data, content_type)
+        return key
+
+    async def get(self, key: str) -> Optional[Tuple[bytes, str]]:
+        return await asyncio.to_thread(self._read, key)
+
+    async def exists(self, key: str) -> bool:
+        return await asyncio.to_thread(os.path.exists, self._path(key))
+
+
+class GridFSMediaStore(MediaStore):
+    def __init__(self, database=db, bucket_name: str = "media"):
+        self.bucket = AsyncIOMotorGridFSBucket(database, bucket_name=bucket_name)
+        self.files = database[f"{bucket_name}.files"]
+
+    async def put(self, data: bytes, content_type: str, key: Optional[str] = None) -> str:
+        key = key or hashlib.sha256(data).hexdigest()
+        if await self.files.find_one({"filename": key}, {"_id": 1}) is None:
+            await self.bucket.upload_from_stream(key, data, metadata={"contentType": content_type})
+        return key
+
+    async def get(self, key: str) -> Optional[Tuple[bytes, str]]:
+        info = await self.files.find_one({"filename": key}, {"metadata": 1})
+        if info is None:
+            return None
+        stream = await self.bucket.open_download_stream(info["_id"])
+        return await stream.read(), (info.get("metadata") or {}).get("contentType", "application/octet-stream")
+
+    async def exists(self, key: str) -> bool:
+        return await self.files.find_one({"filename": key}, {"_id": 1}) is not None
+
+
+def create_media_store(backend: str = MEDIA_BACKEND) -> MediaStore:
+    if backend == "gridfs":
+        return GridFSMediaStore()
+    return LocalMediaStore()
+
+
+media_store = create_media_store()
+
+
+async def store_profile_picture(pp: str, base_url: Optional[str] = None) -> str:
+    """
+    Decode a data URL once and keep only a reference to it on the user record.
+    Anything that is not a data URL (already a reference or an external link) is kept as is.
+    `base_url` is the origin the request came in on, used when MEDIA_BASE_URL is unset.
+    """
+    if not pp or not pp.startswith("data:"):
+        return pp
+    content_type, data = parse_data_url(pp)
+    return media_url(await media_store.put(data, content_type), base_url)
+
+
+def _thumbnail(data: bytes, size: int) -> Tuple[bytes, str]:
+    with Image.open(io.BytesIO(data)) as image:
+        image.thumbnail((size, size))
+        out = io.BytesIO()
+        image.convert("RGBA").save(out, format="PNG", optimize=True)
+    return out.getvalue(), "image/png"
+
+
+async def load_media(digest: str, size: Optional[int]) -> Optional[Tuple[bytes, str, str]]:
+    """Return (bytes, content type, etag) for an original or a cached thumbnail of it."""
+    if size is None or Image is None:
+        stored = await media_store.get(digest)
+        return (*stored, digest) if stored else None
+
+    key = f"{digest}-{size}"
+    stored = await media_store.get(key)
+    if stored is None:
+        original = await media_store.get(digest)
+        if original is None:
+            return None
+        try:
+            data, content_type = await asyncio.to_thread(_thumbnail, original[0], size)
+        except Exception as e:
+            logger.warning("Could not thumbnail %s: %s", digest, e)
+            return (*original, digest)
+        await media_store.put(data, content_type, key=key)
+        stored = data, content_type
+    return (*stored, key)
+
+
+def parse_range(header: str, length: int) -> Optional[Tuple[int, int]]:
+    """Single "bytes=start-end" range as inclusive offsets, None if unsatisfiable."""
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", header.strip())
+    if not match or match.group(1) == match.group(2) == "":
+        return None
+    if match.group(1) == "":
+        start, end = max(length - int(match.group(2)), 0), length - 1
+    else:
+        start = int(match.group(1))
+        end = min(int(match.group(2)), length - 1) if match.group(2) else length - 1
+    if start > end or start >= length:
+        return None
+    return start, end
+
+
+async def serve_media(digest: str, request: Request, size: Optional[int] = None) -> Response:
+    if not DIGEST_PATTERN.match(digest):
+        raise HTTPException(status_code=404, detail="Media not found")
+    if size is not None and size not in THUMBNAIL_SIZES:
+        raise HTTPException(status_code=400, detail=f"size must be one of {THUMBNAIL_SIZES}")
+
+    # Content never changes for a key, so the key itself is the validator
+    etag_key = digest if size is None else f"{digest}-{size}"
+    headers = {
+        "ETag": f'"{etag_key}"',
+        "Cache-Control": "public, max-age=31536000, immutable",
+        "Accept-Ranges": "bytes",
+        # Never let a stored blob be sniffed or rendered as a document
+        "X-Content-Type-Options": "nosniff",
+        "Content-Disposition": "inline",
+        "Content-Security-Policy": "default-src 'none'; sandbox",
+    }
+    if request.headers.get("if-none-match", "").strip('" ') in (etag_key, "*"):
+        # A thumbnail can always be made again from its original, so that is what has to exist
+        if not await media_store.exists(digest):
+            raise HTTPException(status_code=404, detail="Media not found")
+        return Response(status_code=304, headers=headers)
+
+    loaded = await load_media(digest, size)
+    if loaded is None:
+        raise HTTPException(status_code=404, detail="Media not found")
+    data, content_type, etag_key = loaded
+    headers["ETag"] = f'"{etag_key}"'
+    if content_type not in ALLOWED_IMAGE_TYPES:
+        # Stored before types were checked
+        content_type = "application/octet-stream"
+
+    range_header = request.headers.get("range")
+    if range_header:
+        byte_range = parse_range(range_header, len(data))
+        if byte_range is None:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{len(data)}"})
+        start, end = byte_range
+        headers["Content-Range"] = f"bytes {start}-{end}/{len(data)}"
+        return Response(content=data[start:end + 1], status_code=206, media_type=content_type, headers=headers)
+    return Response(content=data, media_type=content_type, headers=headers)
+
+
+async def migrate_profile_pictures(batch_size: int = 100):
+    """Move legacy inline data URLs out of usersreg.pp; safe to run repeatedly."""
+    if not MEDIA_BASE_URL:
+        logger.warning("Profile picture migration skipped: MEDIA_BASE_URL is not set")
+        return
+    migrated = 0
+    cursor = user_collection.find({"pp": {"$regex": "^data:"}}, {"pp": 1}).batch_size(batch_size)
+    async for user in cursor:
+        try:
+            reference = await store_profile_picture(user["pp"])
+        except ValueError as e:
+            logger.warning("Skipping unreadable profile picture on %s: %s", user["_id"], e)
+            continue
+        await user_collection.update_one({"_id": user["_id"], "pp": user["pp"]}, {"$set": {"pp": reference}})
+        migrated += 1
+    if migrated:
+        logger.info("Moved %d profile pictures into the media store", migrated)
@@ -0,0 +1,278 @@
+# metrics.py
+import asyncio
+import sys
+import threading
+import time
+from bisect import bisect_left
+from os import getenv
+from typing import Callable, Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+from pymongo import monitoring
+
+load_dotenv()
+
+METRICS_ENABLED = getenv("METRICS_ENABLED", "1") != "0"
+LOOP_LAG_INTERVAL_SECONDS = float(getenv("LOOP_LAG_INTERVAL_SECONDS", "0.5"))
+
+# Response appends the charset
+CONTENT_TYPE = "text/plain; version=0.0.4"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+FAST_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+# Everything below renders in registration order on /metrics
+REGISTRY = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values: Dict[Tuple, float] = {}
+        # Mongo events arrive on Motor's executor threads
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, *labels, amount: float = 1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in list(self.values.items()):
+            yield f"{self.name}{_format_labels(self.labels, labels)} {value}"
+
+
+class Gauge:
+    """A value read when /metrics is scraped: `fn` returns a number, or a dict of label tuples to numbers."""
+
+    def __init__(self, name: str, help: str, fn: Callable, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.labels = labels
+        REGISTRY.append(self)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} gauge"
+        value = self.fn()
+        if isinstance(value, dict):
+            for labels, sample in value.items():
+                yield f"{self.name}{_format_labels(self.labels, labels)} {sample}"
+        else:
+            yield f"{self.name} {value}"
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts (+Inf last), sum, count]
+        self.series: Dict[Tuple, list] = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value: float, *labels):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, (counts, total, count) in list(self.series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                le = 'le="%s"' % bound
+                yield f"{self.name}_bucket{_format_labels(self.labels, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labels, labels)} {total}"
+            yield f"{self.name}_count{_format_labels(self.labels, labels)} {count}"
+
+
+_scrapes = 0
+
+
+def register_stats(prefix: str, stats: Callable[[], dict]):
+    """
+    Expose the numeric fields of an existing stats() dict as konnectit_<prefix>_<field> gauges.
+    stats() is called once per scrape, however many fields it has.
+    """
+    cached = [-1, None]
+
+    def field(key):
+        if cached[0] != _scrapes:
+            cached[:] = [_scrapes, stats()]
+        return cached[1][key]
+
+    for key, value in stats().items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            Gauge(f"konnectit_{prefix}_{key}", f"{prefix} {key.replace('_', ' ')}", lambda key=key: field(key))
+
+
+def read_rss_bytes() -> int:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource  # Peak RSS is the best we can do off Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+
+def render() -> str:
+    global _scrapes
+    _scrapes += 1
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+http_request_seconds = Histogram(
+    "konnectit_http_request_seconds", "HTTP request latency by route", ("method", "route"))
+http_requests_total = Counter(
+    "konnectit_http_requests_total", "HTTP requests by route and status", ("method", "route", "status"))
+mongo_command_seconds = Histogram(
+    "konnectit_mongo_command_seconds", "MongoDB command latency", ("command", "collection"), FAST_BUCKETS)
+mongo_command_failures_total = Counter(
+    "konnectit_mongo_command_failures_total", "Failed MongoDB commands", ("command", "collection"))
+broadcast_seconds = Histogram(
+    "konnectit_broadcast_seconds", "Time to fan a message out to its recipients' channels", ("kind",),
+    FAST_BUCKETS)
+loop_lag_seconds = Histogram(
+    "konnectit_event_loop_lag_seconds", "How late the event loop ran a scheduled wakeup", (), FAST_BUCKETS)
+
+
+class MetricsMiddleware:
+    """
+    Plain ASGI middleware timing HTTP requests. Routes are labelled by their
+    path template (/messages/{chatId}/{sender_email}), not the raw path, to
+    keep the number of series bounded.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.route_paths: Dict[Callable, str] = {}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not METRICS_ENABLED:
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # The router stores the matched endpoint in the (shared) scope
+            route = self._route(scope)
+            http_request_seconds.observe(time.perf_counter() - started, scope["method"], route)
+            http_requests_total.inc(scope["method"], route, status_code)
+
+    def _route(self, scope) -> str:
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "unmatched"
+        path = self.route_paths.get(endpoint)
+        if path is None:
+            for route in scope["app"].routes:
+                if getattr(route, "endpoint", None) is endpoint:
+                    path = route.path
+                    break
+            self.route_paths[endpoint] = path = path or "unknown"
+        return path
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """Times every command the driver sends; pass it to the client's event_listeners."""
+
+    def __init__(self):
+        self.collections: Dict[Tuple, str] = {}
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        self.collections[(event.connection_id, event.request_id)] = \
+            collection if isinstance(collection, str) else ""
+
+    def succeeded(self, event):
+        collection = self.collections.pop((event.connection_id, event.request_id), "")
+        mongo_command_seconds.observe(event.duration_micros / 1e6, event.command_name, collection)
+
+    def failed(self, event):
+        collection = self.collections.pop((event.connection_id, event.request_id), "")
+        mongo_command_seconds.observe(event.duration_micros / 1e6, event.command_name, collection)
+        mongo_command_failures_total.inc(event.command_name, collection)
+
+
+mongo_listener = MongoCommandListener()
+
+
+class LoopLagMonitor:
+    """
+    Sleeps a fixed interval and records how much later than asked the loop woke it.
+    Set `samples` to a list to also keep every raw sample (the load test reads them).
+    """
+
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL_SECONDS):
+        self.interval = interval
+        self.last = 0.0
+        self.samples: Optional[List[float]] = None
+        self.task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self.task is None and METRICS_ENABLED:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.last = max(0.0, loop.time() - started - self.interval)
+            loop_lag_seconds.observe(self.last)
+            if self.samples is not None:
+                self.samples.append(self.last)
+
+
+loop_lag_monitor = LoopLagMonitor()
+Gauge("konnectit_process_rss_bytes", "Resident memory of this process", read_rss_bytes)
+Gauge("konnectit_event_loop_lag_last_seconds", "Most recent event loop lag sample", lambda: loop_lag_monitor.last)
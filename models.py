@@ -40,7 +40,11 @@ class ChangePPRequest(BaseModel):
 
 class GroupChat(BaseModel):
     chatName: str
-    participants: list
+    participants: List[EmailStr]
+
+
+class GroupMembersRequest(BaseModel):
+    participants: List[EmailStr]
 
 
 class Message(BaseModel):
@@ -0,0 +1,181 @@
+# persistence.py
+import asyncio
+import logging
+import time
+from os import getenv
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+from bson import ObjectId
+from dotenv import load_dotenv
+from pymongo.errors import BulkWriteError
+
+from db import message_collection
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+WRITE_BATCH_SIZE = int(getenv("WRITE_BATCH_SIZE", "500"))
+WRITE_FLUSH_INTERVAL_MS = int(getenv("WRITE_FLUSH_INTERVAL_MS", "50"))
+WRITE_QUEUE_SIZE = int(getenv("WRITE_QUEUE_SIZE", "10000"))
+
+
+class WriteBehindQueue:
+    """
+    Buffers documents in a bounded queue and writes them with insert_many once
+    a batch fills up or the flush window closes, whichever comes first.
+
+    submit() assigns the _id up front so callers can deliver the document right
+    away, and returns a future that resolves once it is durable. A full queue
+    makes submit() wait, which pushes back on the producer instead of growing
+    memory without bound.
+    """
+
+    def __init__(self, collection, batch_size: int = WRITE_BATCH_SIZE,
+                 flush_interval_ms: int = WRITE_FLUSH_INTERVAL_MS, max_queue: int = WRITE_QUEUE_SIZE):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self.task: Optional[asyncio.Task] = None
+        self.closed = False
+        # Sequence numbers of submitted/processed documents, for sync()
+        self.submitted = 0
+        self.processed = 0
+        self.sync_waiters: List[Tuple[int, asyncio.Future]] = []
+        # Called with each batch's successfully written documents, in write order
+        self.flush_listeners: List[Callable[[List[dict]], Awaitable[None]]] = []
+
+        # Metrics
+        self.written = 0
+        self.failed = 0
+        self.flushes = 0
+        self.last_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+        self.total_flush_seconds = 0.0
+
+    async def start(self):
+        if self.task is None:
+            self.closed = False
+            self.task = asyncio.create_task(self._run())
+
+    async def submit(self, document: dict) -> asyncio.Future:
+        if self.closed:
+            raise RuntimeError("Write-behind queue is draining, no new writes accepted")
+        # Always server-assigned: ids are the delivery sequence (cursors, watermarks, replay)
+        document["_id"] = ObjectId()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((document, future))
+        self.submitted += 1
+        return future
+
+    def add_flush_listener(self, listener: Callable[[List[dict]], Awaitable[None]]):
+        """Run `listener` after every flush; drain() waits for it, and its errors never fail a write."""
+        self.flush_listeners.append(listener)
+
+    async def sync(self):
+        """Wait until everything submitted before this call has been written (or failed)."""
+        target = self.submitted
+        if self.processed >= target or self.task is None:
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self.sync_waiters.append((target, waiter))
+        await waiter
+
+    async def drain(self):
+        """Stop accepting writes, flush everything still queued, then stop the worker."""
+        self.closed = True
+        if self.task is None:
+            return
+        await self.queue.join()
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue.qsize(),
+            "queue_capacity": self.queue.maxsize,
+            "written": self.written,
+            "failed": self.failed,
+            "flushes": self.flushes,
+            "last_flush_ms": round(self.last_flush_seconds * 1000, 3),
+            "max_flush_ms": round(self.max_flush_seconds * 1000, 3),
+            "avg_flush_ms": round(self.total_flush_seconds * 1000 / self.flushes, 3) if self.flushes else 0.0,
+        }
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                    continue
+                except asyncio.QueueEmpty:
+                    pass
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            await self._flush(batch)
+
+    async def _flush(self, batch: List[Tuple[dict, asyncio.Future]]):
+        started = time.perf_counter()
+        failures = {}
+        try:
+            await self.collection.insert_many([document for document, _ in batch], ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get("writeErrors", []):
+                failures[error["index"]] = RuntimeError(error.get("errmsg", "write failed"))
+        except Exception as e:
+            failures = {index: e for index in range(len(batch))}
+        elapsed = time.perf_counter() - started
+
+        self.flushes += 1
+        self.last_flush_seconds = elapsed
+        self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+        self.total_flush_seconds += elapsed
+        self.failed += len(failures)
+        self.written += len(batch) - len(failures)
+        if failures:
+            logger.error("Failed to persist %d of %d documents to %s", len(failures), len(batch), self.collection.name)
+
+        for index, (document, future) in enumerate(batch):
+            if not future.done():
+                if index in failures:
+                    future.set_exception(failures[index])
+                else:
+                    future.set_result(document["_id"])
+
+        if self.flush_listeners and len(failures) < len(batch):
+            written = [document for index, (document, _) in enumerate(batch) if index not in failures]
+            for listener in self.flush_listeners:
+                try:
+                    await listener(written)
+                except Exception as e:
+                    logger.error("Flush listener on %s failed: %s", self.collection.name, e)
+
+        for _ in batch:
+            self.queue.task_done()
+
+        self.processed += len(batch)
+        if self.sync_waiters:
+            still_waiting = []
+            for target, waiter in self.sync_waiters:
+                if self.processed >= target:
+                    if not waiter.done():
+                        waiter.set_result(None)
+                else:
+                    still_waiting.append((target, waiter))
+            self.sync_waiters = still_waiting
+
+
+message_writer = WriteBehindQueue(message_collection)
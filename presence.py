@@ -0,0 +1,184 @@
+# presence.py
+import asyncio
+import json
+import logging
+import time
+import uuid
+from datetime import datetime
+from os import getenv
+from typing import Dict, Iterable, Optional, Set
+
+from dotenv import load_dotenv
+
+from broker import broker
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# A user nobody has heard from for this long is considered gone
+PRESENCE_TIMEOUT_SECONDS = int(getenv("PRESENCE_TIMEOUT_SECONDS", "90"))
+PRESENCE_SWEEP_SECONDS = int(getenv("PRESENCE_SWEEP_SECONDS", "30"))
+# Most users one status stream may watch
+PRESENCE_MAX_WATCHED = int(getenv("PRESENCE_MAX_WATCHED", "500"))
+PRESENCE_SUBSCRIBER_QUEUE_SIZE = 100
+# Identifies this process in presence events; other nodes track which nodes hold each user
+NODE_ID = getenv("NODE_ID") or uuid.uuid4().hex[:12]
+
+PRESENCE_CHANNEL = "presence"
+
+
+def format_status(stats: dict) -> dict:
+    return {
+        "online": stats["online"],
+        "last_seen": stats["last_seen"].isoformat() if stats["last_seen"] else None,
+    }
+
+
+class PresenceRegistry:
+    """
+    Online/last-seen state with change notifications.
+
+    Every change is published on the broker's presence channel and applied
+    when it comes back, so all nodes share one view and subscribers are
+    pushed a delta only when something actually changed.
+
+    A user is online while any node holds one of their sockets (any device):
+    events name the node they come from, and a user only goes offline once
+    the last node holding them says so.
+
+    Each node heartbeats the users whose sockets it holds with one batched
+    refresh per sweep. A node that didn't refresh a user within
+    PRESENCE_TIMEOUT_SECONDS stops counting, which cleans up after a node that
+    died without saying goodbye.
+    """
+
+    def __init__(self):
+        self.status: Dict[str, dict] = {}  # email -> {"online", "last_seen"}
+        self.holders: Dict[str, Dict[str, float]] = {}  # email -> {node: monotonic deadline}
+        self.local: Dict[str, int] = {}  # email -> sockets held by this node
+        self.subscribers: Dict[str, Set[asyncio.Queue]] = {}
+        self.sweeper: Optional[asyncio.Task] = None
+
+    async def start(self):
+        await broker.subscribe(PRESENCE_CHANNEL, self._on_broker_message)
+        if self.sweeper is None:
+            self.sweeper = asyncio.create_task(self._sweep())
+
+    async def stop(self):
+        if self.sweeper is not None:
+            self.sweeper.cancel()
+            try:
+                await self.sweeper
+            except asyncio.CancelledError:
+                pass
+            self.sweeper = None
+        await broker.unsubscribe(PRESENCE_CHANNEL)
+
+    def get(self, email: str) -> Optional[dict]:
+        stats = self.status.get(email)
+        return format_status(stats) if stats is not None else None
+
+    async def connected(self, email: str):
+        self.local[email] = self.local.get(email, 0) + 1
+        if self.local[email] == 1:
+            await self._publish(email, True, None)
+
+    async def disconnected(self, email: str):
+        remaining = self.local.get(email, 0) - 1
+        if remaining > 0:
+            self.local[email] = remaining
+            return
+        self.local.pop(email, None)
+        await self._publish(email, False, datetime.utcnow())
+
+    async def logged_out(self, email: str):
+        # Not tied to a node: only takes effect if none of the user's devices is still connected
+        await self._publish(email, False, datetime.now(), node=None)
+
+    def subscribe(self, emails: Iterable[str]) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=PRESENCE_SUBSCRIBER_QUEUE_SIZE)
+        for email in emails:
+            self.subscribers.setdefault(email, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue, emails: Iterable[str]):
+        for email in emails:
+            watchers = self.subscribers.get(email)
+            if watchers is None:
+                continue
+            watchers.discard(queue)
+            if not watchers:
+                del self.subscribers[email]
+
+    async def _publish(self, email: str, online: bool, last_seen: Optional[datetime], node: Optional[str] = NODE_ID):
+        await broker.publish(PRESENCE_CHANNEL, json.dumps({
+            "type": "delta",
+            "email": email,
+            "online": online,
+            "last_seen": last_seen.isoformat() if last_seen else None,
+            "node": node,
+        }))
+
+    async def _on_broker_message(self, channel: str, payload: str):
+        event = json.loads(payload)
+        node = event.get("node")
+        if event["type"] == "refresh":
+            deadline = time.monotonic() + PRESENCE_TIMEOUT_SECONDS
+            for email in event["emails"]:
+                self.holders.setdefault(email, {})[node] = deadline
+                if email not in self.status or not self.status[email]["online"]:
+                    self._apply(email, True, None)
+            return
+        email = event["email"]
+        if event["online"]:
+            self.holders.setdefault(email, {})[node] = time.monotonic() + PRESENCE_TIMEOUT_SECONDS
+            self._apply(email, True, None)
+            return
+        holders = self.holders.get(email)
+        if holders:
+            holders.pop(node, None)
+            if holders:
+                return  # Still connected through another node
+            del self.holders[email]
+        last_seen = datetime.fromisoformat(event["last_seen"]) if event["last_seen"] else None
+        self._apply(email, False, last_seen)
+
+    def _apply(self, email: str, online: bool, last_seen: Optional[datetime]):
+        previous = self.status.get(email)
+        if previous is not None and previous["online"] == online and previous["last_seen"] == last_seen:
+            return
+        stats = {"online": online, "last_seen": last_seen}
+        self.status[email] = stats
+
+        watchers = self.subscribers.get(email)
+        if not watchers:
+            return
+        delta = {"email": email, **format_status(stats)}
+        for queue in watchers:
+            if queue.full():
+                # Slow watcher: the newest state is what matters
+                queue.get_nowait()
+            queue.put_nowait(delta)
+
+    async def _sweep(self):
+        while True:
+            await asyncio.sleep(PRESENCE_SWEEP_SECONDS)
+            try:
+                if self.local:
+                    # One batched keep-alive for every socket this node holds
+                    await broker.publish(PRESENCE_CHANNEL, json.dumps({"type": "refresh", "emails": list(self.local)}))
+                now = time.monotonic()
+                for email, holders in list(self.holders.items()):
+                    for node in [node for node, deadline in holders.items() if deadline < now]:
+                        if node != NODE_ID or email not in self.local:
+                            del holders[node]
+                    if not holders:
+                        del self.holders[email]
+                        logger.info("Presence for %s expired", email)
+                        self._apply(email, False, datetime.utcnow())
+            except Exception as e:
+                logger.error("Presence sweep failed: %s", e)
+
+
+presence = PresenceRegistry()
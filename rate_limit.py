@@ -0,0 +1,142 @@
+# rate_limit.py
+import logging
+import time
+from collections import OrderedDict
+from os import getenv
+from typing import Optional
+
+from dotenv import load_dotenv
+
+from broker import BROKER_URL
+from logging_config import sampled
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # Only needed for RATE_LIMIT_BACKEND=redis
+    aioredis = None
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# "local" limits per worker; "redis" shares the buckets between workers
+RATE_LIMIT_BACKEND = getenv("RATE_LIMIT_BACKEND", "local")
+RATE_LIMIT_REDIS_URL = getenv("RATE_LIMIT_REDIS_URL", BROKER_URL)
+# Messages a user may send over all their sockets, per second and in a burst
+RATE_LIMIT_USER_PER_SECOND = float(getenv("RATE_LIMIT_USER_PER_SECOND", "10"))
+RATE_LIMIT_USER_BURST = float(getenv("RATE_LIMIT_USER_BURST", "30"))
+# Same for everything arriving from one client address
+RATE_LIMIT_IP_PER_SECOND = float(getenv("RATE_LIMIT_IP_PER_SECOND", "50"))
+RATE_LIMIT_IP_BURST = float(getenv("RATE_LIMIT_IP_BURST", "100"))
+# Buckets kept in memory per limiter; the least recently used one is forgotten (i.e. refilled)
+RATE_LIMIT_MAX_KEYS = int(getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+
+# Token bucket in Redis, refilled from the server's clock so workers' clocks don't matter.
+# Returns 0 when allowed, else milliseconds until `cost` tokens are available.
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens >= cost then
+    tokens = tokens - cost
+else
+    wait = math.ceil((cost - tokens) / rate * 1000)
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return wait
+"""
+
+
+class RateLimiter:
+    """
+    Token buckets keyed by user or address.
+
+    The local bucket is checked first and synchronously, so a client that is
+    already over its limit is rejected without awaiting anything. With a
+    shared backend, requests that pass locally are then charged against the
+    bucket all workers share; if that backend is unreachable the local
+    limit still applies.
+    """
+
+    def __init__(self, name: str, rate: float, burst: float, shared=None, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.shared = shared
+        self.max_keys = max_keys
+        self.buckets: "OrderedDict[str, list]" = OrderedDict()  # key -> [tokens, last refill]
+        self.script = shared.register_script(TOKEN_BUCKET_SCRIPT) if shared is not None else None
+        self.allowed = 0
+        self.rejected = 0
+        self.shared_errors = 0
+
+    def take_local(self, key: str, cost: float = 1) -> float:
+        """0 if `cost` tokens were taken, else seconds until they would be available."""
+        now = time.monotonic()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [self.burst, now]
+            if len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] >= cost:
+            bucket[0] -= cost
+            return 0.0
+        return (cost - bucket[0]) / self.rate
+
+    async def take(self, key: str, cost: float = 1) -> float:
+        wait = self.take_local(key, cost)
+        if not wait and self.script is not None:
+            try:
+                wait = int(await self.script(keys=[f"ratelimit:{self.name}:{key}"],
+                                             args=[self.rate, self.burst, cost])) / 1000
+            except Exception as e:
+                self.shared_errors += 1
+                logger.warning("Shared rate limit backend failed: %s", e, extra=sampled(limiter=self.name))
+        if wait:
+            self.rejected += 1
+        else:
+            self.allowed += 1
+        return wait
+
+    def stats(self) -> dict:
+        return {"keys": len(self.buckets), "allowed": self.allowed, "rejected": self.rejected,
+                "shared_errors": self.shared_errors}
+
+
+def _shared_backend():
+    if RATE_LIMIT_BACKEND != "redis":
+        return None
+    if aioredis is None:
+        raise RuntimeError("RATE_LIMIT_BACKEND=redis but the 'redis' package is not installed")
+    if not RATE_LIMIT_REDIS_URL:
+        raise RuntimeError("RATE_LIMIT_BACKEND=redis needs RATE_LIMIT_REDIS_URL (or a Redis BROKER_URL)")
+    return aioredis.from_url(RATE_LIMIT_REDIS_URL)
+
+
+_shared = _shared_backend()
+user_limiter = RateLimiter("user", RATE_LIMIT_USER_PER_SECOND, RATE_LIMIT_USER_BURST, _shared)
+ip_limiter = RateLimiter("ip", RATE_LIMIT_IP_PER_SECOND, RATE_LIMIT_IP_BURST, _shared)
+
+
+# A frame can never carry more chat messages than a full bucket holds, or it could never be let through
+MAX_MESSAGES_PER_FRAME = max(1, int(min(RATE_LIMIT_USER_BURST, RATE_LIMIT_IP_BURST)))
+
+
+async def check_message_rate(user_email: str, address: Optional[str], cost: int = 1) -> float:
+    """Charge `cost` messages to the user and their address; returns seconds to wait, 0 if allowed."""
+    wait = await user_limiter.take(user_email, cost)
+    if not wait and address:
+        wait = await ip_limiter.take(address, cost)
+    return wait
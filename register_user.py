@@ -1,23 +1,25 @@
-import base64
+from typing import Optional
 
 from fastapi import HTTPException
 
 from db import user_collection, serialize_user
+from media import store_profile_picture
 from models import User
 from schemas import UserCreate
-from utils import hash_password
-import base64
+from utils import password_hasher
 
 
-
-async def register_user(user: UserCreate):
-    existing_user = await user_collection.find_one({"email": user.email})
+async def register_user(user: UserCreate, base_url: Optional[str] = None):
+    existing_user = await user_collection.find_one({"email": user.email}, {"_id": 1})
     if existing_user:
         raise HTTPException(status_code=400, detail="Email already registered")
-    image_data = base64.b64decode(user.pp.split(',')[1])
-    print(image_data) 
+    # The image goes to the media store; the user record only keeps its URL
+    try:
+        pp = await store_profile_picture(user.pp, base_url)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid profile picture: {e}")
 
-    hashed_password = hash_password(user.password)
-    new_user = User(username=user.username, email=user.email, hashed_password=hashed_password, chats=[], pp=str(user.pp))
+    hashed_password = await password_hasher.hash(user.password)
+    new_user = User(username=user.username, email=user.email, hashed_password=hashed_password, chats=[], pp=pp)
     result = await user_collection.insert_one(new_user.dict())
     return serialize_user({**new_user.dict(), "_id": result.inserted_id})
@@ -0,0 +1,95 @@
+# search.py
+import asyncio
+import logging
+from os import getenv
+from typing import Dict, List, Optional
+
+from bson import ObjectId
+from dotenv import load_dotenv
+from fastapi import HTTPException, Response
+
+from db import user_collection, message_collection, group_chat_collection, chat_clear_collection, \
+    conversation_key, serialize_message, MESSAGE_PROJECTION
+from groups import group_conversation_key, require_member
+from logging_config import fields
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+SEARCH_MAX_LIMIT = 50
+SEARCH_MAX_OFFSET = int(getenv("SEARCH_MAX_OFFSET", "500"))
+SEARCH_MAX_QUERY_LENGTH = 200
+# Per-conversation text queries in flight for one search
+SEARCH_CONCURRENCY = int(getenv("SEARCH_CONCURRENCY", "16"))
+
+
+async def visible_conversations(email: str) -> Dict[str, Optional[ObjectId]]:
+    """Every conversation the user takes part in, mapped to their "cleared before" watermark (if any)."""
+    user = await user_collection.find_one({"email": email}, {"chats": 1})
+    conversations: Dict[str, Optional[ObjectId]] = {
+        conversation_key(email, str(chat)): None for chat in (user or {}).get("chats", [])
+    }
+    async for group in group_chat_collection.find({"participants": email}, {"_id": 1}):
+        conversations[group_conversation_key(str(group["_id"]))] = None
+    async for clear in chat_clear_collection.find({"email": email}, {"conversation": 1, "before": 1}):
+        if clear["conversation"] in conversations:
+            conversations[clear["conversation"]] = clear["before"]
+    return conversations
+
+
+async def _search_conversation(conversation: str, query: str, before: Optional[ObjectId], limit: int) -> List[dict]:
+    # The text index is prefixed by conversation, so this only touches that
+    # conversation's postings
+    criteria = {"conversation": conversation, "$text": {"$search": query}}
+    if before is not None:
+        criteria["_id"] = {"$gt": before}
+    return await message_collection.find(criteria, {**MESSAGE_PROJECTION, "score": {"$meta": "textScore"}}).sort(
+        [("score", {"$meta": "textScore"})]
+    ).limit(limit).to_list(length=limit)
+
+
+async def search_messages(email: str, query: str, response: Response = None, chat_id: Optional[str] = None,
+                          group_id: Optional[str] = None, limit: int = 20, offset: int = 0) -> List[dict]:
+    """
+    Best matches first across the caller's conversations (or just one of them),
+    skipping anything they cleared. Paged by offset; X-Next-Offset is set while
+    there are more results.
+    """
+    query = query.strip()
+    if not query or len(query) > SEARCH_MAX_QUERY_LENGTH:
+        raise HTTPException(status_code=400, detail="Search query must be 1-200 characters")
+    if offset > SEARCH_MAX_OFFSET:
+        raise HTTPException(status_code=400, detail=f"offset can't exceed {SEARCH_MAX_OFFSET}")
+
+    conversations = await visible_conversations(email)
+    if group_id:
+        await require_member(group_id, email)
+        key = group_conversation_key(group_id)
+        conversations = {key: conversations.get(key)}
+    elif chat_id:
+        key = conversation_key(email, chat_id)
+        conversations = {key: conversations.get(key)}
+
+    # Each conversation contributes at most offset + limit + 1 candidates,
+    # enough to fill the requested page and tell whether another one exists
+    wanted = offset + limit + 1
+    semaphore = asyncio.Semaphore(SEARCH_CONCURRENCY)
+
+    async def search_one(conversation, before):
+        async with semaphore:
+            return await _search_conversation(conversation, query, before, wanted)
+
+    try:
+        batches = await asyncio.gather(*(search_one(conversation, before)
+                                         for conversation, before in conversations.items()))
+    except Exception as e:
+        logger.error("Search failed: %s", e, extra=fields(user=email))
+        raise HTTPException(status_code=500, detail="Search failed")
+
+    matches = sorted((message for batch in batches for message in batch),
+                     key=lambda message: (message["score"], message["_id"]), reverse=True)
+    page = matches[offset:offset + limit]
+    if response is not None and len(matches) > offset + limit:
+        response.headers["X-Next-Offset"] = str(offset + limit)
+    return [{**serialize_message(message), "score": round(message["score"], 4)} for message in page]
@@ -1,20 +1,22 @@
 import logging
 
 from fastapi import Query, HTTPException
-from jose import jwt, JWTError
+from jose import JWTError
 from starlette import status
 
-from auth import SECRET_KEY, ALGORITHM
+from auth import verify_token
+
+logger = logging.getLogger(__name__)
 
 
 async def validate_token_endpoint(token: str = Query(...)):
     try:
         # Decode the token using the secret key and algorithm
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        logging.debug(f"Token payload: {payload}")
+        payload = verify_token(token)
+        logger.debug("Token payload: %s", payload)
         return {"isValid": True}  # If no exception is raised, the token is valid
     except JWTError:
-        logging.error("Invalid token")
+        logger.error("Invalid token")
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid token",
@@ -1,100 +1,345 @@
+import asyncio
 import json
 import logging
+import re
+import time
 from datetime import datetime
-from typing import Dict
+from os import getenv
+from typing import Optional
 
-from jose import jwt, JWTError
-from pydantic import EmailStr
+from dotenv import load_dotenv
+from jose import JWTError
 from starlette.websockets import WebSocket, WebSocketDisconnect
 
-from auth import SECRET_KEY, ALGORITHM
-from db import message_collection
+from auth import verify_token
+from broker import broker, user_channel, keyed_payload, split_key
+from calls import call_manager, CALL_SIGNAL_TYPES
+from connection import Connection
+from connection_registry import connection_registry
+from db import conversation_key, message_collection
+from delivery import delivery_tracker, parse_message_id, replay
+from encoding import dumps_str
+from groups import group_membership, group_conversation_key
+from inbox import mark_read
+from logging_config import fields, sampled
+from metrics import broadcast_seconds
+from persistence import message_writer
+from presence import presence
+from rate_limit import check_message_rate, MAX_MESSAGES_PER_FRAME
+from wire import negotiate, FrameTooLarge, MalformedFrame
 
-# Dictionary to store active WebSocket connections and user status
-active_connections: Dict[EmailStr, WebSocket] = {}
-user_status: Dict[EmailStr, dict] = {}  # Tracks online status and last seen time
+load_dotenv()
 
-async def websocket_endpoint(websocket: WebSocket, token: str):
+logger = logging.getLogger(__name__)
+
+# Inbound frames above this size, compressed or once inflated, close the socket.
+# Run uvicorn with --ws-max-size set to the same value to bound it at the network layer too
+WS_MAX_FRAME_BYTES = int(getenv("WS_MAX_FRAME_BYTES", "65536"))
+# Rate-limited frames in a row before the client is disconnected
+WS_MAX_REJECTED_FRAMES = int(getenv("WS_MAX_REJECTED_FRAMES", "20"))
+
+RECEIPT_STATUSES = ("delivered", "read")
+# ?device=... on /ws: stable per install, so the device keeps its own delivery cursor
+DEVICE_ID_PATTERN = re.compile(r"[A-Za-z0-9_.:-]{1,64}")
+PONG = json.dumps({"type": "pong"})
+# Control frames are never stored, so they don't count against the message rate limit
+UNCHARGED_TYPES = frozenset(("ping", "receipt", *CALL_SIGNAL_TYPES))
+
+
+async def websocket_endpoint(websocket: WebSocket, token: str, since: Optional[str] = None,
+                             device: Optional[str] = None):
     try:
         # Decode the token to get the current user
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = verify_token(token)
         current_user_email = payload.get("sub")
         if not current_user_email:
             await websocket.close(code=1008, reason="Invalid token")
             return
+        if device is not None and not DEVICE_ID_PATTERN.fullmatch(device):
+            await websocket.close(code=1008, reason="Invalid device id")
+            return
+
+        # Accept the WebSocket connection with the encoding the client asked for
+        codec, subprotocol = negotiate(websocket)
+        await websocket.accept(subprotocol=subprotocol)
+        connection = Connection(websocket, current_user_email, codec, device=device)
+        # A user may have several sockets (devices); the first one on this
+        # node routes the user's messages here, wherever they are published
+        if connection_registry.add(connection):
+            await broker.subscribe(user_channel(current_user_email), deliver_local)
+        logger.info("User %s connected", current_user_email,
+                    extra=fields(device=device, connections=len(connection_registry)))
 
-        # Accept the WebSocket connection
-        await websocket.accept()
-        active_connections[current_user_email] = websocket
-        logging.info(f"User {current_user_email} connected. Active connections: {list(active_connections.keys())}")
+        # Mark user as online; watchers are pushed the change
+        await presence.connected(current_user_email)
 
-        # Mark user as online and update status
-        user_status[current_user_email] = {"online": True, "last_seen": None}
-        print(f"{current_user_email} is now online")
+        # Catch up on whatever arrived while this device was away
+        await replay(connection, current_user_email, parse_message_id(since))
 
+        address = websocket.client.host if websocket.client else None
+        rejected_in_a_row = 0
         try:
             while True:
-                # Receive messages and update activity timestamp
-                data = await websocket.receive_text()
-                message = json.loads(data)
-                message["sender"] = current_user_email
-                await message_collection.insert_one(message)
-                await broadcast(message)
-
-                # Update user activity
-                user_status[current_user_email] = {
-                    "online": True,
-                    "last_seen": datetime.utcnow(),
-                }
+                # A frame may carry several messages (JSON array or binary batch)
+                data = await receive_frame(websocket)
+                connection.touch()
+                try:
+                    if frame_too_large(data):
+                        raise FrameTooLarge()
+                    messages = codec.decode(data, WS_MAX_FRAME_BYTES)
+                except FrameTooLarge:
+                    connection.stop()
+                    await websocket.close(code=1009, reason="Frame too large")
+                    break
+                except MalformedFrame as e:
+                    connection.send(json.dumps({"type": "error", "detail": "Malformed frame"}))
+                    logger.warning("Malformed frame from %s: %s", current_user_email, e,
+                                   extra=sampled(user=current_user_email))
+                    continue
+                cost = chargeable(messages)
+                if cost > MAX_MESSAGES_PER_FRAME:
+                    # Not retryable as sent: the client has to split the batch
+                    connection.send(json.dumps({
+                        "type": "error",
+                        "detail": "Too many messages in one frame",
+                        "maxMessages": MAX_MESSAGES_PER_FRAME,
+                        "clientMsgIds": client_msg_ids(messages),
+                    }))
+                    continue
+                # Over-limit frames are answered and dropped here, before any database work
+                wait = await check_message_rate(current_user_email, address, cost) if cost else 0
+                if wait:
+                    rejected_in_a_row += 1
+                    if rejected_in_a_row > WS_MAX_REJECTED_FRAMES:
+                        connection.stop()
+                        await websocket.close(code=1008, reason="Rate limit exceeded")
+                        break
+                    connection.send(json.dumps({
+                        "type": "error",
+                        "detail": "Rate limit exceeded",
+                        "retryAfter": round(wait, 3),
+                        "clientMsgIds": client_msg_ids(messages),
+                    }))
+                    continue
+                rejected_in_a_row = 0
+                for message in messages:
+                    try:
+                        await handle_message(connection, current_user_email, message)
+                    except Exception as e:
+                        # One bad message costs an error frame, not the connection
+                        logger.error("Could not handle message from %s: %s", current_user_email, e,
+                                     extra=fields(user=current_user_email, type=message.get("type")))
+                        connection.send(json.dumps({"type": "error", "detail": "Could not handle message",
+                                                    "clientMsgId": message.get("clientMsgId")}))
         except WebSocketDisconnect:
-            logging.info(f"User {current_user_email} disconnected.")
+            pass
         finally:
             # Handle disconnection: mark user as offline
-            active_connections.pop(current_user_email, None)
-            logging.info(
-                f"User {current_user_email} disconnected. Active connections: {list(active_connections.keys())}")
-
-            user_status[current_user_email] = {
-                "online": False,
-                "last_seen": datetime.utcnow(),
-            }
-            print(f"{current_user_email} went offline at {user_status[current_user_email]['last_seen']}")
+            connection.stop()
+            connection_registry.remove(connection)
+            # Checked rather than taken from remove(): the reaper may have unregistered this socket already
+            if not connection_registry.is_connected(current_user_email):
+                await broker.unsubscribe(user_channel(current_user_email))
+            logger.info("User %s disconnected", current_user_email,
+                        extra=fields(device=device, connections=len(connection_registry)))
+
+            await presence.disconnected(current_user_email)
     except JWTError as e:
         await websocket.close(code=1008, reason="Invalid token")
-        logging.error(f"JWTError: {e}")
+        logger.error("JWTError: %s", e)
     except Exception as e:
         await websocket.close(code=1011, reason="Internal server error")
-        logging.error(f"WebSocket Error: {e}")
+        logger.error("WebSocket Error: %s", e)
+
+
+def frame_too_large(data) -> bool:
+    if isinstance(data, bytes):
+        return len(data) > WS_MAX_FRAME_BYTES
+    # Text is measured in UTF-8 bytes; a character takes at most 4, so short frames skip the encode
+    return len(data) * 4 > WS_MAX_FRAME_BYTES and len(data.encode()) > WS_MAX_FRAME_BYTES
+
+
+def chargeable(messages: list) -> int:
+    """How many of the frame's messages would be persisted as chat messages."""
+    return sum(1 for message in messages
+               if not isinstance(message, dict) or message.get("type") not in UNCHARGED_TYPES)
 
 
-async def broadcast(message: dict):
+def client_msg_ids(messages: list) -> list:
+    return [message.get("clientMsgId") for message in messages
+            if isinstance(message, dict) and message.get("clientMsgId") is not None]
+
+
+async def receive_frame(websocket: WebSocket):
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000))
+    return message["text"] if message.get("text") is not None else message["bytes"]
+
+
+async def handle_message(connection: Connection, current_user_email: str, message: dict):
+    if message.get("type") == "receipt":
+        await handle_receipt(current_user_email, message, connection.device)
+        return
+    if message.get("type") in CALL_SIGNAL_TYPES:
+        # Call signalling is relayed, never stored as a chat message
+        error = await call_manager.signal(current_user_email, message)
+        if error is not None:
+            connection.send(json.dumps({"type": "error", "detail": error, "roomId": message.get("roomId")}))
+        return
+    if message.get("type") == "ping":
+        # Keepalive; receiving it already counted as activity
+        connection.send(PONG)
+        return
+    message["sender"] = current_user_email
+    # Pages are keyed on (timestamp, _id), so the server's clock decides the order, not the client's
+    message["timestamp"] = datetime.utcnow().isoformat()
+    # History is read by conversation key, so it is only ever derived here, never taken from the client
+    message.pop("conversation", None)
+    recipients = None
+    if message.get("groupId"):
+        recipients = await group_membership.members_of(str(message["groupId"]))
+        if recipients is None or current_user_email not in recipients:
+            connection.send(json.dumps({"type": "error", "detail": "Not a member of this group",
+                                        "clientMsgId": message.get("clientMsgId")}))
+            return
+        message["groupId"] = str(message["groupId"])
+        message["conversation"] = group_conversation_key(message["groupId"])
+    elif message.get("chatId"):
+        message["conversation"] = conversation_key(current_user_email, message["chatId"])
+    else:
+        connection.send(json.dumps({"type": "error", "detail": "Message needs a chatId or groupId",
+                                    "clientMsgId": message.get("clientMsgId")}))
+        return
+    # Queue the write (waits only when the queue is full) and deliver right away
+    persisted = await message_writer.submit(message)
+    await broadcast(message, recipients)
+    persisted.add_done_callback(
+        lambda future, client_msg_id=message.get("clientMsgId"): acknowledge(
+            current_user_email, client_msg_id, future)
+    )
+
+
+async def broadcast(message: dict, recipients=None):
     """
     This function broadcasts the message to both users in the chat.
     The message chatId is now the email of the recipient, so we need to handle both users involved.
+    Group messages go to the given recipients (the group's members) instead.
     """
+    # Encode once, share the payload across recipients and publish concurrently;
+    # each recipient's node only queues it on that socket's own send queue
+    started = time.perf_counter()
+    payload = dumps_str(message)
+
+    if recipients is not None:
+        logger.debug("Broadcasting group message", extra=sampled(group=message["groupId"], members=len(recipients)))
+        try:
+            await broker.publish_many((user_channel(member) for member in recipients), payload)
+        except Exception as e:
+            logger.error("Error publishing group message: %s", e, extra=fields(group=message["groupId"]))
+        broadcast_seconds.observe(time.perf_counter() - started, "group")
+        return
+
     chat_id = message.get("chatId")
     if not chat_id:
-        logging.warning("Message without chatId received. Skipping broadcast.")
+        logger.warning("Message without chatId received. Skipping broadcast.")
         return
 
     # Assuming `chatId` corresponds to the recipient's email. Get both participants:
     user_emails = [message["sender"], chat_id]  # Both sender and recipient need to receive the message
 
-    # Debugging Logs
-    logging.debug(f"Broadcasting message to users: {user_emails}")
-
-    if "_id" in message:
-        message["_id"] = str(message["_id"])
-
-    # Send message to each user connected
-    for user_email in user_emails:
-        if user_email in active_connections:
-            try:
-                # Send the message to the user
-                await active_connections[user_email].send_text(json.dumps(message))
-                logging.info(f"Message sent to {user_email}")
-            except Exception as e:
-                # Error handling for failed message delivery
-                logging.error(f"Error sending message to {user_email}: {e}")
-                # Clean up broken connections
-                active_connections.pop(user_email, None)
+    logger.debug("Broadcasting message", extra=sampled(sender=message["sender"], chat_id=chat_id))
+
+    results = await asyncio.gather(
+        *(broker.publish(user_channel(user_email), payload) for user_email in user_emails),
+        return_exceptions=True
+    )
+    for user_email, result in zip(user_emails, results):
+        if isinstance(result, Exception):
+            logger.error("Error publishing message to %s: %s", user_email, result, extra=fields(user=user_email))
+    broadcast_seconds.observe(time.perf_counter() - started, "direct")
+
+
+async def handle_receipt(user_email: str, receipt: dict, device: Optional[str] = None):
+    """
+    {"type": "receipt", "status": "delivered" | "read", "id": <message id>, "to": <sender>}
+    advances the device's delivery cursor and is relayed to the original sender.
+    A read receipt (with "groupId" for group messages) also clears the inbox unread count
+    and is echoed to the user's own devices so they clear it too. Receipts for a group the
+    user isn't in, or for a message outside their chat with "to", are dropped.
+    """
+    message_id = parse_message_id(receipt.get("id"))
+    status = receipt.get("status")
+    if message_id is None or status not in RECEIPT_STATUSES:
+        logger.warning("Ignoring malformed receipt from %s", user_email, extra=sampled(user=user_email))
+        return
+    # Read implies delivered
+    delivery_tracker.ack(user_email, message_id, device)
+    sender = receipt.get("to")
+    if sender is not None:
+        sender = str(sender)
+    if receipt.get("groupId"):
+        peer = {"groupId": str(receipt["groupId"])}
+        members = await group_membership.members_of(peer["groupId"])
+        if members is None or user_email not in members or (sender and sender not in members):
+            logger.warning("Ignoring receipt for a group %s is not in", user_email, extra=sampled(user=user_email))
+            return
+        conversation = group_conversation_key(peer["groupId"])
+    elif sender:
+        peer = {"chatId": sender}
+        conversation = conversation_key(user_email, sender)
+        if not await in_conversation(message_id, conversation):
+            logger.warning("Ignoring receipt for a message outside %s's chat with %s", user_email, sender,
+                           extra=sampled(user=user_email))
+            return
+    else:
+        peer = conversation = None
+    if status == "read" and peer is not None:
+        await mark_read(user_email, conversation, message_id)
+        # Only the newest read position per conversation matters to a device that is behind
+        await broker.publish(user_channel(user_email), keyed_payload(
+            f"read_sync:{peer.get('groupId') or peer['chatId']}", json.dumps({
+                "type": "read_sync",
+                **peer,
+                "id": str(message_id),
+                "device": device,
+            })))
+    if sender:
+        relayed = {"type": "receipt", "status": status, "id": str(message_id), "by": user_email}
+        if receipt.get("groupId"):
+            relayed["groupId"] = str(receipt["groupId"])
+        # Likewise the newest receipt of each status from this reader in this conversation
+        await broker.publish(user_channel(sender), keyed_payload(
+            f"receipt:{user_email}:{relayed.get('groupId', '')}:{status}", json.dumps(relayed)))
+
+
+async def in_conversation(message_id, conversation: str) -> bool:
+    query = {"_id": message_id, "conversation": conversation}
+    if await message_collection.find_one(query, {"_id": 1}) is not None:
+        return True
+    # Receipts often beat the write-behind flush of the message they acknowledge
+    await message_writer.sync()
+    return await message_collection.find_one(query, {"_id": 1}) is not None
+
+
+def acknowledge(user_email: str, client_msg_id, future: asyncio.Future):
+    """Tell the sender whether its message was persisted, if it asked for an ack."""
+    error = future.exception()
+    if error is not None:
+        logger.error("Message from %s was not persisted: %s", user_email, error, extra=fields(user=user_email))
+    if client_msg_id is None:
+        return
+    if error is not None:
+        ack = {"type": "ack", "clientMsgId": client_msg_id, "status": "failed"}
+    else:
+        ack = {"type": "ack", "clientMsgId": client_msg_id, "status": "persisted", "id": str(future.result())}
+    asyncio.ensure_future(broker.publish(user_channel(user_email), json.dumps(ack)))
+
+
+async def deliver_local(channel: str, payload: str):
+    """Broker handler: queue a routed payload on each of the user's sockets held by this node."""
+    user_email = channel.split(":", 1)[1]
+    key, payload = split_key(payload)
+    for connection in connection_registry.get(user_email):
+        if not connection.send(payload, key):
+            logger.warning("Dropped message: send queue full", extra=sampled(user=user_email))
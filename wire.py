@@ -0,0 +1,191 @@
+# wire.py
+import json
+import struct
+import zlib
+from os import getenv
+from typing import List, Optional, Tuple, Union
+
+from starlette.websockets import WebSocket
+
+try:
+    import msgpack
+except ImportError:  # Without msgpack every client gets the JSON protocol
+    msgpack = None
+
+# Frames smaller than this are not worth deflating
+WIRE_COMPRESS_MIN_BYTES = int(getenv("WIRE_COMPRESS_MIN_BYTES", "256"))
+# Most queued messages a binary connection packs into one frame
+WIRE_MAX_BATCH = int(getenv("WIRE_MAX_BATCH", "64"))
+
+SUBPROTOCOL_JSON = "konnectit.json"
+SUBPROTOCOL_MSGPACK = "konnectit.msgpack"
+SUBPROTOCOL_MSGPACK_DEFLATE = "konnectit.msgpack+deflate"
+
+# Fixed field order for chat messages on the binary protocol; anything else
+# rides along in a trailing map
+MESSAGE_FIELDS = ("_id", "type", "sender", "chatId", "groupId", "content", "timestamp",
+                  "conversation", "clientMsgId", "identifier")
+KIND_MESSAGE = 0
+KIND_MAP = 1
+
+FLAG_RAW = b"\x00"
+FLAG_DEFLATE = b"\x01"
+
+Frame = Union[str, bytes]
+
+
+class FrameTooLarge(ValueError):
+    """An inbound frame that decompresses to more than the allowed size."""
+
+
+class MalformedFrame(ValueError):
+    """An inbound frame that doesn't decode to a list of message objects."""
+
+
+def _objects(items: list) -> List[dict]:
+    if not all(isinstance(item, dict) for item in items):
+        raise MalformedFrame("Frame items must be objects")
+    return items
+
+
+def _inflate(data: bytes, max_bytes: Optional[int]) -> bytes:
+    if max_bytes is None:
+        return zlib.decompress(data, wbits=-15)
+    # Bounded output: a few KB of deflate can expand to gigabytes
+    inflater = zlib.decompressobj(wbits=-15)
+    inflated = inflater.decompress(data, max_bytes)
+    if inflater.unconsumed_tail:
+        raise FrameTooLarge(f"Frame inflates past {max_bytes} bytes")
+    return inflated
+
+
+class JsonCodec:
+    """The original protocol: one JSON object per text frame (a JSON array of them is accepted inbound)."""
+
+    name = SUBPROTOCOL_JSON
+    binary = False
+    max_batch = 1
+
+    def item(self, payload: str) -> str:
+        return payload
+
+    def frames(self, items: List[str]) -> List[Frame]:
+        return items
+
+    def decode(self, data: Frame, max_bytes: Optional[int] = None) -> List[dict]:
+        try:
+            decoded = json.loads(data)
+        except ValueError as e:
+            raise MalformedFrame(f"Invalid JSON: {e}") from e
+        return _objects(decoded if isinstance(decoded, list) else [decoded])
+
+
+def _to_item(obj: dict) -> list:
+    if "content" in obj and "sender" in obj:
+        values = [obj.get(field) for field in MESSAGE_FIELDS]
+        extras = {key: value for key, value in obj.items() if key not in MESSAGE_FIELDS}
+        return [KIND_MESSAGE, values, extras]
+    return [KIND_MAP, obj]
+
+
+def _from_item(item) -> dict:
+    if isinstance(item, dict):
+        return item
+    if not isinstance(item, list) or len(item) < 2:
+        raise MalformedFrame("Unknown item layout")
+    if item[0] == KIND_MESSAGE and isinstance(item[1], list):
+        message = {field: value for field, value in zip(MESSAGE_FIELDS, item[1]) if value is not None}
+        if len(item) > 2 and item[2]:
+            if not isinstance(item[2], dict):
+                raise MalformedFrame("Unknown item layout")
+            message.update(item[2])
+        return message
+    if item[0] == KIND_MAP and isinstance(item[1], dict):
+        return item[1]
+    raise MalformedFrame("Unknown item layout")
+
+
+def _array_header(length: int) -> bytes:
+    if length < 16:
+        return bytes([0x90 | length])
+    if length < 0x10000:
+        return b"\xdc" + struct.pack(">H", length)
+    return b"\xdd" + struct.pack(">I", length)
+
+
+# Broker payloads are JSON; a message fanned out to many binary clients on
+# this node is converted once, not once per recipient
+_last_converted: Tuple[Optional[str], bytes] = (None, b"")
+
+
+class MsgpackCodec:
+    """
+    Binary protocol: every frame is a MessagePack array of items, so several
+    messages can share one frame. Chat messages use the fixed MESSAGE_FIELDS
+    layout instead of repeating key names. With deflate negotiated, frames
+    start with a flag byte saying whether the rest is raw-deflated.
+    """
+
+    binary = True
+    max_batch = WIRE_MAX_BATCH
+
+    def __init__(self, compress: bool = False):
+        self.compress = compress
+        self.name = SUBPROTOCOL_MSGPACK_DEFLATE if compress else SUBPROTOCOL_MSGPACK
+
+    def item(self, payload: str) -> bytes:
+        global _last_converted
+        if _last_converted[0] is payload:
+            return _last_converted[1]
+        packed = msgpack.packb(_to_item(json.loads(payload)), use_bin_type=True)
+        _last_converted = (payload, packed)
+        return packed
+
+    def frames(self, items: List[bytes]) -> List[Frame]:
+        frame = _array_header(len(items)) + b"".join(items)
+        if not self.compress:
+            return [frame]
+        if len(frame) < WIRE_COMPRESS_MIN_BYTES:
+            return [FLAG_RAW + frame]
+        compressor = zlib.compressobj(wbits=-15)
+        return [FLAG_DEFLATE + compressor.compress(frame) + compressor.flush()]
+
+    def decode(self, data: Frame, max_bytes: Optional[int] = None) -> List[dict]:
+        """`max_bytes` bounds the decompressed size; past it FrameTooLarge is raised."""
+        if isinstance(data, str):
+            # Control messages may still arrive as JSON text
+            return JsonCodec().decode(data)
+        if self.compress:
+            flag, data = data[:1], data[1:]
+            if flag == FLAG_DEFLATE:
+                try:
+                    data = _inflate(data, max_bytes)
+                except zlib.error as e:
+                    raise MalformedFrame(f"Invalid deflate stream: {e}") from e
+        try:
+            decoded = msgpack.unpackb(data, raw=False)
+        except (ValueError, msgpack.UnpackException) as e:
+            raise MalformedFrame(f"Invalid MessagePack: {e}") from e
+        if isinstance(decoded, dict):
+            return [decoded]
+        if not isinstance(decoded, list):
+            raise MalformedFrame("Frame must be an array of items")
+        return [_from_item(item) for item in decoded]
+
+
+def negotiate(websocket: WebSocket):
+    """
+    Pick the codec from the offered subprotocols (or ?encoding=msgpack&compress=deflate
+    for clients that can't set them). Returns (codec, subprotocol to accept with).
+    JSON stays the fallback, including when msgpack isn't installed.
+    """
+    offered = websocket.scope.get("subprotocols") or []
+    if msgpack is not None:
+        for subprotocol in offered:
+            if subprotocol == SUBPROTOCOL_MSGPACK_DEFLATE:
+                return MsgpackCodec(compress=True), subprotocol
+            if subprotocol == SUBPROTOCOL_MSGPACK:
+                return MsgpackCodec(), subprotocol
+        if websocket.query_params.get("encoding") == "msgpack":
+            return MsgpackCodec(compress=websocket.query_params.get("compress") == "deflate"), None
+    return JsonCodec(), SUBPROTOCOL_JSON if SUBPROTOCOL_JSON in offered else None